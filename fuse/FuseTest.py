@@ -5,27 +5,57 @@ import llfuse
 import errno
 from collections import defaultdict
 from time import time
+from contextlib import contextmanager
 import os
-import sys
 import logging
 from stat import *
-import struct
+import argparse
+import threading
+from testfs import Storage, TestFSHeader, InodeTable, Blocks, PageCache, Directory, \
+                   Readahead, Defragmenter, NULL_BLOCK, INLINE_SIZE
 
-def logger(func):
-    def _logger(*args, **kargs):
-        logging.debug("Called %s%s."%(func.__name__, args[1:]))
-        return func(*args, **kargs)
-    return _logger
+def unlocked(func):
+    '''
+    llfuseのグローバルロックを外して実行する、排他はContentBufferのinode毎のロックで行う
+    中から別のunlockedな関数を呼ばないこと
+    '''
+    def _unlocked(*args, **kargs):
+        with llfuse.lock_released:
+            return func(*args, **kargs)
+    _unlocked.__name__ = func.__name__
+    return _unlocked
 
 class Operations(llfuse.Operations):
     '''
     fhとinodeは同じ値を使いまわす
+    ハンドラは複数のスレッドから同時に呼ばれるので、触るinodeはContentBuffer.lockedでロックする
     '''
 
-    def __init__(self, path):
+    stats_name = ".testfs-stats"
+
+    def __init__(self, path, cache_size=None, writeback_interval=5,
+                 dirty_limit=16*2**20, metrics=False, defrag_rate=0):
         super(Operations, self).__init__()
-        self.contents = ContentBuffer(path)
+        self.contents = ContentBuffer(path, cache_size)
         self.inode_count = defaultdict(int)
+        self.readahead = Readahead(self.contents.storage, self.contents.header)
+        # 統計はルート直下の読み出し専用のファイルとして見せる、inode番号は使われない最初の番号
+        self.metrics = None
+        self.stats_inode = self.contents.header.max_ino + llfuse.ROOT_INODE
+        self.stats_text = ""
+        if metrics:
+            self.metrics = Metrics()
+            self.metrics.instrument(self)
+        # writeback_intervalが0ならwrite毎に書き出す
+        self.dirty_limit = dirty_limit
+        self.flusher = None
+        if writeback_interval > 0:
+            self.flusher = Flusher(self.contents, writeback_interval)
+        # defrag_rate(byte/s)が0ならバックグラウンドのデフラグはしない
+        self.defragger = None
+        if defrag_rate > 0:
+            self.defragger = Defragger(self.contents,
+                                       defrag_rate / self.contents.header.block_size)
         try:
             self.contents[llfuse.ROOT_INODE]
         except KeyError:
@@ -39,478 +69,826 @@ class Operations(llfuse.Operations):
             inode = self._create_entry(mode, ctx)
             self.contents[inode].add_child(".", inode)
 
-    @logger
+    def init(self):
+        self.readahead.start()
+        if self.flusher is not None:
+            self.flusher.start()
+        if self.defragger is not None:
+            self.defragger.start()
+
+    # 1.0より前のllfuseはfhしか返せずkeep_cacheを指定できない
+    # 統計のファイルのようにカーネルの知らない所で変わるものは_invalidateで捨ててもらう
+    @unlocked
     def open(self, inode, flags):
-        self.inode_count[inode] += 1
+        if inode == self.stats_inode:
+            self.inode_count[inode] += 1
+            return inode
+        with self.contents.locked(inode):
+            self.inode_count[inode] += 1
         return inode
 
-    @logger
+    @unlocked
     def opendir(self, inode):
-        self.inode_count[inode] += 1
+        with self.contents.locked(inode):
+            self.inode_count[inode] += 1
         return inode
 
-    @logger
+    @unlocked
     def create(self, inode_p, name, mode, flags, ctx):
-        inode = self._create_entry(mode, ctx)
-        self.contents[inode_p].add_child(name, inode)
-        return (inode, self.contents[inode].get_stat())
+        with self.contents.operation():
+            inode = self._create_entry(mode, ctx)
+            with self.contents.locked(inode_p, inode):
+                self.contents[inode_p].add_child(name, inode)
+                self.inode_count[inode] += 1  # 開いた状態で返すので後でreleaseされる
+                return (inode, self.contents[inode].get_stat())
 
-    @logger
+    @unlocked
     def getattr(self, inode):
-        return self.contents[inode].get_stat()
+        return self._getattr(inode)
 
-    @logger
+    @unlocked
     def setattr(self, inode, attr):
-        s = self.contents[inode].get_stat()
-        changed = ""
-        for i in attr.__slots__:
-            st = getattr(attr, i)
-            if st is not None:
-                setattr(s, i, st)
-                changed = i
-                break;
-        else:
-            logging.warning("Failed in setattr. Unknown attribute.")
-            raise llfuse.FUSEError(errno.ENOSYS)
-        if changed == 'st_size':
-            self.contents[inode].data.set_size(attr.st_size)
+        if inode == self.stats_inode:
+            raise llfuse.FUSEError(errno.EACCES)
+        with self.contents.locked(inode):
+            c = self.contents[inode]
+            changed = ""
+            for i in attr.__slots__:
+                st = getattr(attr, i)
+                if st is not None:
+                    changed = i
+                    break;
+            else:
+                logging.warning("Failed in setattr. Unknown attribute.")
+                raise llfuse.FUSEError(errno.ENOSYS)
+            if changed == 'st_size':
+                c.set_size(attr.st_size)
+            if changed in Content.attrs:
+                setattr(c, changed, st)
+            c.modified()
+            s = c.get_stat()
         logging.info("Changed value of %s"%changed)
         return s
 
-    @logger
+    @unlocked
     def read(self, fh, off, size):
-        return self.contents[fh].read(off, size)
-
-    @logger
+        if fh == self.stats_inode:
+            return self.stats_text[off:off+size]
+        with self.contents.locked(fh):
+            c = self.contents[fh]
+            data = c.read(off, size)
+            if not c.is_inline():
+                self.readahead.access(fh, c.data, off, len(data))
+            return data
+
+    @unlocked
     def lookup(self, inode_p, name):
-        try:
-            inode = self.contents[inode_p].get_children()[name]
-            return self.getattr(inode)
-        except KeyError:
-            raise llfuse.FUSEError(errno.ENOENT)
+        if self.metrics is not None and inode_p == llfuse.ROOT_INODE \
+           and name == self.stats_name:
+            return self._getattr(self.stats_inode)
+        return self._getattr(self._lookup(inode_p, name))
 
-    @logger
+    # 1エントリ毎にinodeをロックしてgeneratorで返すので、llfuseのロックは外さない
     def readdir(self, inode, off):
-        c = self.contents[inode].get_children()
-        children = ((name, self.getattr(c[name]), len(c)) for name in c)
-        for i in xrange(off):
-            try:
-                children.next()
-            except StopIteration:
-                break
-        return children
+        # offは前回返したエントリの次のレコードの位置
+        # Content.childrenは初めて触った時に読まれるので、ここからロックを取っておく
+        with self.contents.locked(inode):
+            entries = self.contents[inode].get_entries(off)
+        while True:
+            with self.contents.locked(inode):
+                try:
+                    name, child, next_off = entries.next()
+                except StopIteration:
+                    return
+            # Metricsで包んだgetattrを通すとエントリ毎にgetattrとして数えてしまう
+            yield (name, self._getattr(child), next_off)
 
-    @logger
     def access(self, inode, mode, ctx):
         return True
 
-    @logger
+    @unlocked
     def write(self, fh, offset, buf):
-        c = self.contents[fh]
-        c.write(offset, buf)
-        self.contents.flush()
+        if fh == self.stats_inode:
+            raise llfuse.FUSEError(errno.EACCES)
+        with self.contents.locked(fh):
+            self.contents[fh].write(offset, buf)
+        if self.flusher is None:
+            self.contents.commit()
+        elif self.contents.dirty_bytes() >= self.dirty_limit:
+            self.flusher.wakeup()
         return len(buf)
 
-    @logger
+    @unlocked
     def release(self, fh):
-        self.inode_count[fh] -= 1
-
-    @logger
+        if fh == self.stats_inode:
+            self.inode_count[fh] -= 1
+            return
+        with self.contents.locked(fh):
+            self.inode_count[fh] -= 1
+            if self.inode_count[fh] == 0:
+                self.readahead.forget(fh)
+
+    @unlocked
     def releasedir(self, fh):
-        self.inode_count[fh] -= 1
+        with self.contents.locked(fh):
+            self.inode_count[fh] -= 1
 
-    @logger
+    @unlocked
     def mkdir(self, inode_p, name, mode, ctx):
-        inode = self._create_entry(mode, ctx)
-        self.contents[inode_p].add_child(name, inode)
-        c = self.contents[inode]
-        c.add_child(".", inode)
-        c.inc_ref()
-        c.add_child("..", inode_p)
-        self.contents[inode_p].inc_ref()
-        return c.get_stat()
-
-    @logger
+        with self.contents.operation():
+            inode = self._create_entry(mode, ctx)
+            with self.contents.locked(inode_p, inode):
+                self.contents[inode_p].add_child(name, inode)
+                c = self.contents[inode]
+                c.add_child(".", inode)
+                c.inc_ref()
+                c.add_child("..", inode_p)
+                self.contents[inode_p].inc_ref()
+                return c.get_stat()
+
+    @unlocked
     def forget(self, inode_list):
         for inode, _ in inode_list:
-            if self.contents[inode].get_stat().st_nlink == 0:
-                del self.contents[inode]
+            if inode == self.stats_inode:
+                continue
+            with self.contents.locked(inode):
+                if self.contents[inode].st_nlink == 0:
+                    del self.contents[inode]
 
-    @logger
+    @unlocked
     def link(self, inode, new_parent_inode, new_name):
-        self.contents[new_parent_inode].add_child(new_name, inode)
-        self.contents[inode].inc_ref()
-        return self.contents[inode].get_stat()
+        with self.contents.locked(inode, new_parent_inode):
+            self.contents[new_parent_inode].add_child(new_name, inode)
+            self.contents[inode].inc_ref()
+            return self.contents[inode].get_stat()
 
-    @logger
+    @unlocked
     def rename(self, inode_p_old, name_old, inode_p_new, name_new):
-        inode = self.lookup(inode_p_old, name_old).st_ino
-        self.contents[inode_p_old].del_child(name_old)
-        self.contents[inode_p_new].add_child(name_new, inode)
+        with self.contents.locked(inode_p_old, inode_p_new):
+            inode = self._lookup(inode_p_old, name_old)
+            self.contents[inode_p_old].del_child(name_old)
+            self.contents[inode_p_new].add_child(name_new, inode)
 
-    @logger
+    @unlocked
     def symlink(self, inode_p, name, target, ctx):
         mode = S_IFLNK|S_IRUSR|S_IRGRP|S_IROTH \
                |S_IWUSR|S_IWGRP|S_IWOTH|S_IXUSR|S_IXGRP|S_IXOTH
-        inode, s = self.create(inode_p, name, mode, None, ctx)
-        self.contents[inode].setlink(target)
-        return s
+        with self.contents.operation():
+            inode = self._create_entry(mode, ctx)
+            with self.contents.locked(inode_p, inode):
+                self.contents[inode].setlink(target)
+                self.contents[inode_p].add_child(name, inode)
+                return self.contents[inode].get_stat()
 
-    @logger
+    @unlocked
     def readlink(self, inode):
-        return self.contents[inode].getlink()
+        with self.contents.locked(inode):
+            return self.contents[inode].getlink()
 
-    @logger
+    @unlocked
     def unlink(self, inode_p, name):
-        s = self.lookup(inode_p, name)
-        self.contents[s.st_ino].dec_ref()
-        self.contents[inode_p].del_child(name)
+        inode = self._lookup(inode_p, name)
+        with self.contents.locked(inode_p, inode):
+            self.contents[inode].dec_ref()
+            self.contents[inode_p].del_child(name)
 
-    @logger
+    @unlocked
     def rmdir(self, inode_p, name):
-        s = self.lookup(inode_p, name)
-        if len(self.contents[s.st_ino].get_children()) != 2:
-            raise llfuse.FUSEError(errno.ENOTEMPTY)
-        self.contents[s.st_ino].dec_ref()
-        self.contents[s.st_ino].dec_ref()
-        self.contents[inode_p].del_child(name)
-
-    @logger
+        inode = self._lookup(inode_p, name)
+        with self.contents.locked(inode_p, inode):
+            if len(self.contents[inode].get_children()) != 2:
+                raise llfuse.FUSEError(errno.ENOTEMPTY)
+            self.contents[inode].dec_ref()
+            self.contents[inode].dec_ref()
+            self.contents[inode_p].del_child(name)
+
+    # closeではデータを書き出すだけで、メタデータはFlusherかfsyncのコミットに任せる
+    @unlocked
+    def flush(self, fh):
+        self.contents.flush([fh])
+
+    @unlocked
+    def fsync(self, fh, datasync):
+        self.contents.commit()
+
+    @unlocked
+    def fsyncdir(self, fh, datasync):
+        self.contents.commit()
+
+    @unlocked
     def destroy(self):
-        self.contents.flush()
+        if self.defragger is not None:
+            self.defragger.stop()
+        if self.flusher is not None:
+            self.flusher.stop()
+        self.readahead.stop()
+        self.contents.commit()
+        self.contents.checkpoint()
+        logging.info("Page cache: %s"%self.contents.cache.stats())
+        logging.info("Readahead: %s"%self.readahead.stats())
+        if self.defragger is not None:
+            logging.info("Defrag: %s"%self.defragger.defrag.stats())
+        logging.info("Fragmentation: %s"%self.contents.header.fragmentation())
+        logging.info("Journal: %s"%self.contents.header.journal.stats())
+        if self.metrics is not None:
+            logging.info("Metrics:\n%s"%self.metrics.report())
+        self.contents.close()
 
 #    def mknod(self, inode_p, name, mode, rdev, ctx):
-#    def fsync(self, fh, datasync):
-#    def fsyncdir(self, fh, datasync):
-#    def flush(self, fh):
-#    def statfs(self):
 #    def setxattr(self, name, value):
 #    def getxattr(self, inode, name):
 #    def linkxattr(self, inode):
 #    def removexattr(self, inode, name):
 
-    @logger
-    def _create_entry(self, mode, ctx):
-        inode = self.contents.next_ino()
+    # 空き数はTestFSHeaderが持っているカウンタを読むだけ
+    def statfs(self):
+        header = self.contents.header
+        s = llfuse.StatvfsData()
+        s.f_bsize = header.block_size
+        s.f_frsize = header.block_size
+        s.f_blocks = header.max_blk
+        s.f_bfree = header.free_blocks
+        s.f_bavail = header.free_blocks
+        s.f_files = header.max_ino
+        s.f_ffree = header.free_inodes
+        s.f_favail = header.free_inodes
+        s.f_namemax = 255
+        return s
+
+    def _getattr(self, inode):
+        if inode == self.stats_inode:
+            return self._stats_attr()
+        with self.contents.locked(inode):
+            return self.contents[inode].get_stat()
+
+    def _lookup(self, inode_p, name):
+        with self.contents.locked(inode_p):
+            try:
+                return self.contents[inode_p].get_children()[name]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+
+    # カーネルを通さずに中身が変わったinodeのキャッシュを捨ててもらう
+    # (通知は非同期に送られるのでハンドラの中から呼んでよい)
+    def _invalidate(self, inode, attr_only=False):
+        if self.inode_count[inode] > 0:
+            llfuse.invalidate_inode(inode, attr_only)
+
+    # 統計の中身はlookup/getattrの度に作り直し、その大きさを返す
+    def _stats_attr(self):
+        text = self.metrics.report(self.contents.cache.stats())
+        if text != self.stats_text:
+            self.stats_text = text
+            self._invalidate(self.stats_inode)
         s = llfuse.EntryAttributes()
         s.generation = 0
-        s.entry_timeout = 300
-        s.attr_timeout = 300
-        s.st_ino = inode
-        s.st_mode = mode
+        s.entry_timeout = 0
+        s.attr_timeout = 0
+        s.st_ino = self.stats_inode
+        s.st_mode = S_IFREG|S_IRUSR|S_IRGRP|S_IROTH
         s.st_nlink = 1
-        s.st_uid = ctx.uid
-        s.st_gid = ctx.gid
+        s.st_uid = os.getuid()
+        s.st_gid = os.getgid()
         s.st_rdev = 0
-        s.st_size = 0
-        s.st_blksize = 512
-        s.st_blocks = 1
-        s.st_mtime = int(time())
-        s.st_atime = int(time())
-        s.st_ctime = int(time())
-        self.contents[inode] = Content(s, Blocks(self.contents.header))
+        s.st_size = len(self.stats_text)
+        s.st_blksize = self.contents.header.block_size
+        s.st_blocks = 0
+        s.st_mtime = s.st_atime = s.st_ctime = int(time())
+        return s
+
+    def _create_entry(self, mode, ctx):
+        inode = self.contents.next_ino()
+        now = int(time())
+        self.contents[inode] = Content(self.contents, (inode, 0, mode, 1, ctx.uid, ctx.gid, 0,
+                                                       now, now, now, NULL_BLOCK, ""))
         logging.info("Created entry %s"%inode)
         return inode
 
 
+class Metrics(object):
+    """
+    ハンドラ毎の呼び出し回数、エラー数、バイト数、レイテンシのヒストグラム(2のべき乗のμs毎)
+    instrumentでインスタンスのメソッドを包むので、使わない時はコストがかからない
+    """
+    buckets = 32
+    sizes = {"read": len, "write": lambda r: r}  # 戻り値から読み書きしたバイト数を得る
+    handlers = ["lookup", "getattr", "setattr", "readlink", "mkdir", "unlink", "rmdir",
+                "symlink", "rename", "link", "open", "read", "write", "flush", "release",
+                "fsync", "opendir", "readdir", "releasedir", "fsyncdir", "access",
+                "create", "forget"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = {}  # ハンドラ名 -> [回数, エラー数, バイト数, 合計時間, 最大時間, ヒストグラム]
+
+    def instrument(self, operations):
+        for name in self.handlers:
+            setattr(operations, name, self._wrap(name, getattr(operations, name)))
+
+    def _wrap(self, name, func):
+        stat = self.ops[name] = [0, 0, 0, 0.0, 0.0, [0] * self.buckets]
+        size = self.sizes.get(name)
+        def _measured(*args, **kargs):
+            start = time()
+            try:
+                r = func(*args, **kargs)
+            except:
+                self._record(stat, time() - start, 0, 1)
+                raise
+            self._record(stat, time() - start, size(r) if size else 0, 0)
+            return r
+        return _measured
+
+    def _record(self, stat, elapsed, nbytes, error):
+        bucket = min(int(elapsed * 1e6).bit_length(), self.buckets - 1)
+        with self.lock:
+            stat[0] += 1
+            stat[1] += error
+            stat[2] += nbytes
+            stat[3] += elapsed
+            stat[4] = max(stat[4], elapsed)
+            stat[5][bucket] += 1
+
+    # ヒストグラムからpの割合の呼び出しが収まる上限(μs)を返す
+    def _percentile(self, hist, count, p):
+        n = 0
+        for i, c in enumerate(hist):
+            n += c
+            if n >= count * p:
+                return 2**i
+        return 2**(self.buckets - 1)
+
+    def report(self, cache_stats=None):
+        lines = ["{:<12} {:>10} {:>7} {:>14} {:>10} {:>10} {:>10} {:>10}".format(
+            "op", "calls", "errors", "bytes", "avg(us)", "p50(us)", "p99(us)", "max(us)")]
+        with self.lock:
+            for name in sorted(self.ops):
+                calls, errors, nbytes, total, longest, hist = self.ops[name]
+                if calls == 0:
+                    continue
+                lines.append("{:<12} {:>10} {:>7} {:>14} {:>10.1f} {:>10} {:>10} {:>10.1f}".format(
+                    name, calls, errors, nbytes, total / calls * 1e6,
+                    self._percentile(hist, calls, 0.5), self._percentile(hist, calls, 0.99),
+                    longest * 1e6))
+        if cache_stats is not None:
+            lines.append("page cache: " + " ".join("{}={}".format(k, cache_stats[k])
+                                                   for k in sorted(cache_stats)))
+        return "\n".join(lines) + "\n"
+
+
 class ContentBuffer(object):
+    """
+    Contentのコンテナ
+    メタデータの変更はcommit()でまとめてジャーナルに書く、その間は操作(operation)を止める
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, cache_size=None):
         self.buffer = {}  # メモリ上にのってる
+        self.lock = threading.RLock()  # bufferとlocksを守る
+        self.locks = defaultdict(threading.RLock)  # inode毎のロック
+        self.barrier = threading.Condition(threading.Lock())  # 操作とコミットの間の排他
+        self.active = 0  # 操作中のスレッド数
+        self.capturing = False  # コミットが変更を集めている
+        self.depth = threading.local()  # スレッド毎のoperationの入れ子の深さ
+        self.commit_cond = threading.Condition(threading.Lock())
+        self.committing = False
+        self.commits = 0  # 終わったコミットの数
         self.path = path
-        self.header = TestFSHeader(path)
+        self.storage = Storage(path)
+        self.header = TestFSHeader(self.storage)
+        self.table = InodeTable(self.header)
+        if cache_size is None:
+            cache_size = PageCache.default_size
+        self.cache = PageCache(self.header, cache_size / self.header.block_size)
 
     def next_ino(self):
         return self.header.next_ino()
 
-    def flush(self):
-        update_list = [(i, c) for (i, c) in self.buffer.items() if c.dirty]
-        with open(self.path, 'r+b') as f:
-            for (inode, content) in update_list:
-                s = content.get_stat()
-                f.seek(self.header.content_index2address(inode - llfuse.ROOT_INODE))
-                f.write(Content.struct.pack(s.st_ino, s.generation, s.st_mode,
-                                            s.st_nlink, s.st_uid, s.st_gid, s.st_size,
-                                            s.st_atime, s.st_mtime, s.st_ctime,
-                                            content.data.head))
-                content.data.flush(f)
+    # ディレクトリとシンボリックリンクの中身はmetaにしてジャーナルを通す
+    def new_blocks(self, head=NULL_BLOCK, size=0, meta=False):
+        return Blocks(self.header, self.cache, head, size, meta)
+
+    # 1つのトランザクションに入るべき変更をまとめる、コミットが変更を集めている間は待つ
+    # 入れ子にできる(一番外側だけが数えられる)
+    @contextmanager
+    def operation(self):
+        depth = self._begin()
+        try:
+            yield
+        finally:
+            self._end(depth)
+
+    def _begin(self):
+        depth = getattr(self.depth, "n", 0)
+        if depth == 0:
+            with self.barrier:
+                while self.capturing:
+                    self.barrier.wait()
+                self.active += 1
+        self.depth.n = depth + 1
+        return depth
+
+    def _end(self, depth):
+        self.depth.n = depth
+        if depth == 0:
+            with self.barrier:
+                self.active -= 1
+                if self.active == 0:
+                    self.barrier.notify_all()
+
+    # 操作を全部止める
+    @contextmanager
+    def exclusive(self):
+        with self.barrier:
+            self.capturing = True
+            while self.active > 0:
+                self.barrier.wait()
+        try:
+            yield
+        finally:
+            with self.barrier:
+                self.capturing = False
+                self.barrier.notify_all()
+
+    # inodeのロックを番号順に取る(複数のinodeを触る操作同士でデッドロックしないように)
+    @contextmanager
+    def locked(self, *inodes):
+        with self.lock:
+            locks = [self.locks[i] for i in sorted(set(inodes))]
+        depth = self._begin()
+        for l in locks:
+            l.acquire()
+        try:
+            yield
+        finally:
+            for l in reversed(locks):
+                l.release()
+            self._end(depth)
+
+    def dirty_bytes(self):
+        return (len(self.cache.dirty) + len(self.cache.meta)) * self.header.block_size
+
+    # ファイルの中身を書き出す、inodesを指定するとそのinodeの分だけ
+    def flush(self, inodes=None):
+        if inodes is None:
+            self.cache.flush()
+            return
+        for inode in inodes:
+            with self.locked(inode):
+                content = self.buffer.get(inode)
+                if content is not None and content._data is not None:
+                    self.cache.flush(content.data)
+
+    # 変更されたメタデータをジャーナルに書いてから元の場所に書く
+    # 同時に呼ばれたら後から来たものはまとめて1回で済ませる(group commit)
+    def commit(self):
+        with self.commit_cond:
+            # 実行中のコミットは呼ぶ前の変更を集め終えているかもしれないので、その次を待つ
+            target = self.commits + (2 if self.committing else 1)
+            while self.committing and self.commits < target:
+                self.commit_cond.wait()
+            if self.commits >= target:
+                return
+            self.committing = True
+        done = False
+        try:
+            self._commit()
+            done = True
+        finally:
+            with self.commit_cond:
+                self.committing = False
+                if done:
+                    self.commits += 1
+                self.commit_cond.notify_all()
+
+    def _commit(self):
+        with self.exclusive():
+            # ファイルの中身はメタデータより先にディスクに届くように、ジャーナルより前に書く
+            written = self.cache.flush()
+            for inode, content in self.buffer.items():
+                if not content.dirty:
+                    continue
+                if content._data is not None:
+                    content.data.flush()
+                self.table.put(inode, content.record())
                 content.dirty = False
-        self.header.flush()
+            pages = self.cache.pin_meta()
+            deltas = self.table.deltas() + self.header.deltas()
+        if written:
+            self.storage.sync()
+        if not self.header.commit(deltas, pages, self.cache):
+            logging.warning("Transaction of %d bytes does not fit in the journal."
+                            %sum(len(d) for _, d in deltas + pages))
+
+    # ジャーナルを空にする、Flusherがジャーナルが埋まってきた時に呼ぶ
+    def checkpoint(self):
+        with self.commit_cond:
+            while self.committing:
+                self.commit_cond.wait()
+            self.committing = True
+        try:
+            self.header.journal.checkpoint()
+        finally:
+            with self.commit_cond:
+                self.committing = False
+                self.commit_cond.notify_all()
+
+    def close(self):
+        self.storage.close()
 
     def __getitem__(self, inode):
+        with self.lock:
+            return self._get(inode)
+
+    def _get(self, inode):
         if not inode in self.buffer:
             if not self.header.is_usedino(inode):   # no entry
                 raise KeyError(inode)
-            with open(self.path, 'r+b') as f:
-                stat = llfuse.EntryAttributes()
-                f.seek(self.header.content_index2address(inode - llfuse.ROOT_INODE))
-                (st_ino, generation, st_mode,
-                 st_nlink, st_uid, st_gid, st_size,
-                 st_atime, st_mtime, st_ctime, datap) \
-                    = Content.struct.unpack(f.read(Content.size))
-                stat.st_ino = st_ino
-                stat.generation = generation
-                stat.entry_timeout = 300
-                stat.attr_timeout = 300
-                stat.st_mode = st_mode
-                stat.st_nlink = st_nlink
-                stat.st_uid = st_uid
-                stat.st_gid = st_gid
-                stat.st_rdev = 0
-                stat.st_size = st_size
-                stat.st_blksize = self.header.block_size
-                stat.st_blocks = (st_size-1)/self.header.block_size + 1
-                stat.st_atime = st_atime
-                stat.st_mtime = st_mtime
-                stat.st_ctime = st_ctime
-                self.buffer[inode] = Content(stat, Blocks(self.header, head=datap, size=st_size))
-                f.seek(self.header.block_index2address(datap))
-                d = f.read(stat.st_size)
-                self.buffer[inode].write(0, d)
-                if self.buffer[inode].is_dir():
-                    self.buffer[inode].dec_children()
+            self.buffer[inode] = Content(self, self.table.get(inode))
         return self.buffer[inode]
 
     def __setitem__(self, inode, content):
-        self.buffer[inode] = content
-        self.buffer[inode].dirty = True
+        with self.lock:
+            self.buffer[inode] = content
+            self.buffer[inode].dirty = True
 
     def __delitem__(self, inode):
-        self.header.release_ino(inode)
-        self.buffer[inode].data.release()
-        del self.buffer[inode]
+        with self.lock:
+            self.buffer[inode].release()
+            del self.buffer[inode]
+            self.header.release_ino(inode)
 
 
 class Content(object):
-    struct = struct.Struct("7I4L")
-    size = struct.size
-
-    def __init__(self, stat, blocks):
-        self._stat = stat
+    """
+    1つのinode、属性は__slots__に持ってEntryAttributesはFUSEに返す時だけ作る
+    データ(Blocks)とディレクトリの中身は触られるまで読まない
+    INLINE_SIZE以下のファイルとシンボリックリンクの中身はblockを使わずレコードの中(inline)に置き、
+    それを超えたらblockに移す
+    カーネルに属性とエントリをキャッシュしてもらう時間は最後に変わってからの時間にする
+    (最近変わったものほど早く聞き直してもらい、長く変わっていないものは長く持ってもらう)
+    """
+    min_timeout = 1  # 秒
+    max_timeout = 300
+    attrs = ("st_ino", "generation", "st_mode", "st_nlink", "st_uid", "st_gid",
+             "st_size", "st_atime", "st_mtime", "st_ctime")  # ディスク上のレコードの順
+    __slots__ = attrs + ("contents", "datap", "inline", "dirty", "changed", "_data", "_children")
+
+    def __init__(self, contents, record):
+        self.contents = contents  # ContentBufferのインスタンス
+        (self.st_ino, self.generation, self.st_mode, self.st_nlink, self.st_uid, self.st_gid,
+         self.st_size, self.st_atime, self.st_mtime, self.st_ctime, self.datap, inline) = record
         self.dirty = False
-        self.children = {}
-        self.data = blocks
+        self.changed = max(self.st_mtime, self.st_ctime)  # 最後に変わった時刻(メモリ上だけ)
+        self._data = None
+        self._children = None
+        self.inline = inline[:self.st_size] if self.is_inline() else ""
+
+    # blockに移したら(datapが指すようになったら)、INLINE_SIZE以下に縮んでもblockのまま
+    def is_inline(self):
+        return self._data is None and self.datap == NULL_BLOCK and not self.is_dir()
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.is_inline():
+                self._data = self.contents.new_blocks(NULL_BLOCK, 0, not self.is_reg())
+                self._data.write(0, self.inline)
+                self.inline = ""
+                self.dirty = True
+            else:
+                self._data = self.contents.new_blocks(self.datap, self.st_size,
+                                                      not self.is_reg())
+        return self._data
+
+    @property
+    def children(self):
+        assert self.is_dir(), "Accessed children of the file which is not directory"
+        if self._children is None:
+            self._children = Directory(self.data)
+            self._children.load()
+        return self._children
+
+    # ディスク上のレコードにする値
+    def record(self):
+        if self._data is not None:
+            self.datap = self._data.head
+        return tuple(getattr(self, name) for name in self.attrs) + (self.datap, self.inline)
 
     def read(self, off, size):
+        if self.is_inline():
+            return self.inline[off:off+size]
         return self.data.read(off, size)
 
     def write(self, offset, buf):
+        end = offset + len(buf)
+        if self.is_inline() and end <= INLINE_SIZE:
+            d = self.inline.ljust(offset, "\x00")
+            self.inline = d[:offset] + str(buf) + d[end:]
+            self.st_size = len(self.inline)
+            self.modified()
+            return
         self.data.write(offset, buf)
-        self._stat.st_size = self.data.size
-        self._stat.st_blocks = (self._stat.st_size-1)/512 + 1
+        self._update_size()
+
+    def set_size(self, size):
+        if self.is_inline() and size <= INLINE_SIZE:
+            self.inline = self.inline[:size].ljust(size, "\x00")
+            self.st_size = size
+            self.modified()
+            return
+        self.data.set_size(size)
+        self._update_size()
+
+    def release(self):
+        if not self.is_inline():
+            self.data.release()
+
+    # Defragmenterにblockを移してもらい、動かしたblock数を返す
+    def defragment(self, defrag):
+        if self.is_inline():
+            return 0
+        moved = defrag.relocate(self.data)
+        if moved:
+            self.dirty = True
+        return moved
+
+    def _update_size(self):
+        self.st_size = self.data.size
+        self.modified()
+
+    # 属性か中身が変わった、blockを動かしただけの時はdirtyだけにする
+    def modified(self):
         self.dirty = True
+        self.changed = time()
 
     def get_stat(self):
-        return self._stat
+        s = llfuse.EntryAttributes()
+        for name in self.attrs:
+            setattr(s, name, getattr(self, name))
+        s.entry_timeout = s.attr_timeout = min(max(time() - self.changed, self.min_timeout),
+                                               self.max_timeout)
+        s.st_rdev = 0
+        s.st_blksize = self.contents.header.block_size
+        # st_blocksは512byte単位、確保してあるblock数から数える
+        s.st_blocks = 0 if self.is_inline() else \
+            ((self.st_size-1)/s.st_blksize + 1) * (s.st_blksize/512)
+        return s
 
     def inc_ref(self):
-        self._stat.st_nlink += 1
-        self.dirty = True
+        self.st_nlink += 1
+        self.modified()
 
     def dec_ref(self):
-        self._stat.st_nlink -= 1
-        self.dirty = True
+        self.st_nlink -= 1
+        self.modified()
 
     def add_child(self, name, inode):
         assert self.is_dir(), "Called add_child function on the file which is not directory"
-        self.children[name] = inode
-        s = struct.Struct('IB')
-        d = ""
-        d += s.pack(inode, len(name))
-        d += name
-        self.write(self._stat.st_size, d)
+        self.children.add(name, inode)
+        self._update_size()
 
     def del_child(self, name):
         assert self.is_dir(), "Called del_child function on the file which is not directory"
-        del self.children[name]
-        s = struct.Struct("IB")
-        d = ""
-        for path, inode in self.children.items():
-            d += s.pack(inode, len(path))
-            d += path
-        self.write(0, d)
-        self._stat.st_size = len(d)
+        self.children.remove(name)
+        self._update_size()
 
     def get_children(self):
-        return self.children
-
-    # バイト列を取ってchildrenにセット
-    def dec_children(self):
-        s = struct.Struct('IB')
-        add = 0  # seek位置
-        try :
-            while 1:
-                inode, strlen = s.unpack(self.read(add, s.size))
-                add += s.size
-                path = self.read(add, strlen)
-                add += strlen
-                self.children[path] = inode
-                if add == self._stat.st_size:
-                    break
-        except :
-            print self.children
-            raise
+        return self.children.children
+
+    def get_entries(self, off=0):
+        return self.children.entries(off)
 
     def setlink(self, target):
         assert self.is_link(), "Called setlink function on the file which is not regular file."
         self.write(0, target)
-        self._stat.st_size = len(target)
+        self.st_size = len(target)
 
     def getlink(self):
         assert self.is_link(), "Called getlink function on the file which is not regular file."
-        return self.data.read()
+        return self.read(0, self.st_size)
 
     def is_reg(self):
-        return S_ISREG(self._stat.st_mode)
+        return S_ISREG(self.st_mode)
 
     def is_dir(self):
-        return S_ISDIR(self._stat.st_mode)
+        return S_ISDIR(self.st_mode)
 
     def is_link(self):
-        return S_ISLNK(self._stat.st_mode)
-
-
-class Blocks(object):
-    def __init__(self, header, head=0, size=0):
-        self.header = header  # TestFSHeaderのインスタンス
-        self.head = head  # 保有しているブロックの先頭index
-        self.size = size
-        self.block_size = self.header.block_size
-        self._blk_length = (self.size -1) / self.block_size + 1  # 保有しているブロック数
-        self.max_size = self._blk_length * self.block_size   # 保有している最大サイズ
-        self.data = ""
-
-    def set_size(self, size):
-        if size < self.size:
-            self.data = self.data[:size]
-        self.size = size
-        if self.size > self.max_size:
-            self.release()
-            self._blk_length = (self.size - 1) / self.block_size + 1
-            self.max_size = self._blk_length * self.block_size
-            self.head = self.header.get_space(size)
-
-    def read(self, offset=0, size=0):
-        if size == 0:
-            return self.data[offset:]
-        return self.data[offset:offset+size]
-
-    def write(self, offset, buf):
-        d = self.data
-        d = d[:offset] + buf + d[offset+len(buf):]
-        self.set_size(len(d))
-        self.data = d
-
-    def flush(self, handler):
-        handler.seek(self.header.block_index2address(self.head))
-        handler.write(self.data)
-
-    def release(self):
-        for i in xrange(self.head, self.head + self._blk_length):
-            self.header.release_block(i)
+        return S_ISLNK(self.st_mode)
+
+
+class Flusher(threading.Thread):
+    """
+    dirtyなデータを一定時間毎、またはdirtyな量が閾値を超えて起こされた時にまとめてコミットする
+    ジャーナルが半分を超えたらチェックポイントもここで行う
+    """
+    def __init__(self, contents, interval):
+        super(Flusher, self).__init__(name="testfs-flusher")
+        self.daemon = True
+        self.contents = contents
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    # 途中のコミットが終わるまで待つ、この後でイメージを閉じてよい
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            self.contents.commit()
+            if self.contents.header.journal.usage() > 0.5:
+                self.contents.checkpoint()
+
+
+class Defragger(threading.Thread):
+    """
+    マウント中にファイルを少しずつ詰め直すスレッド
+    空き領域の断片化(TestFSHeader.fragmentationのscore)がthresholdを超えたら1周する
+    動かしたblock数を借りとして数え、平均して1秒にrate blockを超えないようにする
+    """
+    interval = 1  # 秒
+    batch = 1024  # 1回に見るinodeの数
+
+    def __init__(self, contents, rate, threshold=0.5):
+        super(Defragger, self).__init__(name="testfs-defrag")
+        self.daemon = True
+        self.contents = contents
+        self.defrag = Defragmenter(contents.header)
+        self.rate = rate
+        self.threshold = threshold
+        self.budget = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    # 動かしている途中のファイルが終わるまで待つ
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            if self._stopped:
+                break
+            self.budget = min(self.budget + self.rate * self.interval, self.rate * self.interval)
+            if self.budget <= 0:
+                continue
+            # 周の途中なら続け、周の始めでは断片化していなければ休む
+            if self.defrag.cursor == 0 and \
+               self.contents.header.fragmentation()["score"] < self.threshold:
+                continue
+            for _ in xrange(self.batch):
+                inode = self.defrag.next_inode()
+                if inode is None or self._stopped:
+                    break
+                with self.contents.locked(inode):
+                    try:
+                        content = self.contents[inode]
+                    except KeyError:
+                        continue
+                    self.budget -= content.defragment(self.defrag)
+                if self.budget <= 0:
+                    break
 
-class TestFSHeader(object):
-    byte_size = 8
-    block_size = 512
-    def __init__(self, path):
-        self.path = path
-        s = struct.Struct('2I')
-        with open(path, 'rb') as f:
-            self.max_ino, self.max_blk = s.unpack(f.read(s.size))
-            self.inode_bytes = (self.max_ino-1)/self.byte_size+1
-            self.blk_bytes = (self.max_blk-1)/self.byte_size+1
-            self.ino_status = struct.unpack("{}B".format(self.inode_bytes),
-                                            f.read(self.inode_bytes))
-            self.blk_status = struct.unpack("{}B".format(self.blk_bytes),
-                                            f.read(self.blk_bytes))
-            self.ino_status = list(self.ino_status)
-            self.blk_status = list(self.blk_status)
-        # 各データの先頭アドレス
-        self.ino_status_head = s.size
-        self.blk_status_head = self.ino_status_head + self.inode_bytes
-        self.content_head = self.blk_status_head + self.blk_bytes
-        self.data_head = self.content_head
-        self.data_head += Content.size * self.max_ino
-
-    def flush(self):
-        with open(self.path, 'r+b') as f:
-            f.seek(self.ino_status_head)
-            f.write(struct.pack("{}B".format(self.inode_bytes), *self.ino_status))
-            f.write(struct.pack("{}B".format(self.blk_bytes), *self.blk_status))
-
-    # 空いているinode番号を得る
-    def next_ino(self):
-        for i in xrange(self.max_ino):
-            if self._get_bit(self.ino_status, i) == 0:
-                self._set_bit(self.ino_status, i)
-                return i + llfuse.ROOT_INODE
-        raise IOError("All inode entries are used.")
-
-    def release_ino(self, inode):
-        self._del_bit(self.ino_status, inode - llfuse.ROOT_INODE)
-
-    def release_block(self, block):
-        self._del_bit(self.blk_status, block)
-
-    def is_usedino(self, inode):
-        return self._get_bit(self.ino_status, inode - llfuse.ROOT_INODE) == 1
-
-    # indexから実際にディスク上のアドレスを返す
-    def content_index2address(self, index):
-        return self.content_head + Content.size * index
-
-    def block_index2address(self, index):
-        return self.data_head + index * self.block_size
-
-    # 連続領域を探してindexを返す
-    def get_space(self, size):
-        blks = (size - 1)/self.block_size + 1
-        count = 0
-        for i in xrange(len(self.blk_status)):
-            b = self.blk_status[i]
-            for j in xrange(self.byte_size):
-                if (b >> (7-j)) & 1 == 1:
-                    count = 0
-                    continue
-                else:
-                    count += 1
-                if count >= blks:
-                    add = 8*i + j
-                    for k in xrange(blks):
-                        self._set_bit(self.blk_status, add)
-                        add -= 1
-                    return add + 1
-        raise IOError("No space is avilable.")
-
-    def _get_bit(self, bitmap, address):
-        index = address / self.byte_size
-        offset = address % self.byte_size
-        offset = self.byte_size - offset -1
-        return (bitmap[index] >> offset) & 1 == 1
-
-    # bitmapと相対addressを受け取って該当ビットを立てる
-    def _set_bit(self, bitmap, address):
-        index = address / self.byte_size
-        offset = address % self.byte_size
-        offset = self.byte_size - offset -1
-        bitmap[index] = bitmap[index] | (1 << offset)
-
-    def _del_bit(self, bitmap, address):
-        index = address / self.byte_size
-        offset = address % self.byte_size
-        offset = self.byte_size - offset -1
-        bitmap[index] = bitmap[index] & ((2**self.byte_size -1)^(1 << offset))
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        raise SystemExit('Usage: %s <mountpoint>' % sys.argv[0])
+    parser = argparse.ArgumentParser(description='Mount testfs.')
+    parser.add_argument('mountpoint', help='Path to mountpoint. <mountpoint>.tfs is used as data file.')
+    parser.add_argument('-c', '--cache-size', type=int, default=PageCache.default_size / 2**20,
+                        help='Page cache size in MiB.(default {})'.format(PageCache.default_size / 2**20))
+    parser.add_argument('-w', '--writeback-interval', type=float, default=5,
+                        help='Seconds between background flushes, 0 flushes on every write.(default 5)')
+    parser.add_argument('-d', '--dirty-limit', type=int, default=16,
+                        help='Flush early when dirty data exceeds this many MiB.(default 16)')
+    parser.add_argument('-D', '--defrag-rate', type=float, default=0,
+                        help='Defragment in the background at up to this many MiB/s, 0 disables it.(default 0)')
+    parser.add_argument('-m', '--metrics', action='store_true',
+                        help='Collect per-operation metrics, readable from <mountpoint>/.testfs-stats.')
+    args = parser.parse_args()
     logging.basicConfig(format='[%(asctime)s] %(message)s')
-    mountpoint = sys.argv[1]
-    operations = Operations(mountpoint + ".tfs")
+    mountpoint = args.mountpoint
+    operations = Operations(mountpoint + ".tfs", args.cache_size * 2**20,
+                            args.writeback_interval, args.dirty_limit * 2**20,
+                            args.metrics, int(args.defrag_rate * 2**20))
     llfuse.init(operations, mountpoint, ['fsname=testfs', 'nonempty'])
     logging.info('Mounted on %s'%mountpoint)
     try:
-        llfuse.main(single=True)
+        # ハンドラは1.0より前のllfuseの引数(ctx無し)に合わせてあるので、そのmainで複数スレッドで動かす
+        llfuse.main(single=False)
     except:
         llfuse.close(unmount=False)
         raise
@@ -0,0 +1,477 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+
+import argparse
+import json
+import os
+import random
+import resource
+import signal
+import sys
+import tempfile
+import time
+from array import array
+from itertools import islice
+from testfs import Storage, TestFSHeader, PageCache, Blocks, ROOT_INODE
+from dumptestfs import Analyzer
+
+def make_image(path, inodes, blocks, journal=0, block_size=None):
+    TestFSHeader.create(path, inodes, blocks, journal, block_size)
+
+# FuseTestとllfuseを読み込む、stubが真かllfuseが無ければstubllfuseで代用する
+def load_fusetest(stub=False):
+    if not stub:
+        try:
+            import llfuse
+        except ImportError:
+            stub = True
+    if stub:
+        import stubllfuse
+        sys.modules['llfuse'] = stubllfuse
+    import llfuse
+    import FuseTest
+    return FuseTest, llfuse
+
+def report(name, count, elapsed):
+    print "{:<32} {:>10} ops {:>12.0f} ops/s {:>9.2f} us/op".format(
+        name, count, count / elapsed, elapsed / count * 1e6)
+
+def measure(name, count, func):
+    start = time.time()
+    for i in xrange(count):
+        func(i)
+    report(name, count, time.time() - start)
+
+def bench_alloc(args):
+    fd, path = tempfile.mkstemp(suffix='.tfs')
+    os.close(fd)
+    try:
+        make_image(path, args.inodes, args.blocks)
+        start = time.time()
+        storage = Storage(path)
+        header = TestFSHeader(storage)
+        print "{} inodes, {} blocks, loaded in {:.3f} s".format(
+            args.inodes, args.blocks, time.time() - start)
+        n = args.count
+        measure("next_ino", n, lambda i: header.next_ino())
+        singles = []
+        measure("allocate(1) sequential", n,
+                lambda i: singles.extend(header.allocate(1)))
+        measure("allocate(8)", n, lambda i: header.allocate(8))
+        # 1つおきに解放して断片化させる
+        measure("release_block", n / 2,
+                lambda i: header.release_block(singles[2*i][0]))
+        header.flush()  # 解放したblockは書き出すまで再利用されない
+        header.blk_status.hint = 0
+        measure("allocate(64) fragmented", n / 8, lambda i: header.allocate(64))
+        header.blk_status.hint = 0
+        measure("allocate(1) fill holes", n / 2, lambda i: header.allocate(1))
+        measure("allocate(4, goal) append", n,
+                lambda i: header.allocate(4, goal=header.blk_status.hint))
+        start = time.time()
+        header.flush()
+        report("flush bitmaps", 1, time.time() - start)
+        storage.close()
+    finally:
+        os.remove(path)
+
+def bench_write(args):
+    chunk = "\xa5" * args.chunk
+    for mb in args.sizes:
+        size = mb * 2**20
+        blocks = size / TestFSHeader.block_size * 2
+        fd, path = tempfile.mkstemp(suffix='.tfs')
+        os.close(fd)
+        try:
+            make_image(path, 16, blocks)
+            storage = Storage(path)
+            header = TestFSHeader(storage)
+            cache = PageCache(header, args.cache_size * 2**20 / header.block_size)
+            data = Blocks(header, cache)
+            start = time.time()
+            for off in xrange(0, size, args.chunk):
+                data.write(off, chunk)
+            elapsed = time.time() - start
+            print "sequential write {:>6} MiB in {:>6} byte chunks {:>8.2f} s {:>8.2f} MiB/s".format(
+                mb, args.chunk, elapsed, mb / elapsed)
+            start = time.time()
+            for off in xrange(0, size, args.chunk):
+                data.read(off, args.chunk)
+            elapsed = time.time() - start
+            print "sequential read  {:>6} MiB in {:>6} byte chunks {:>8.2f} s {:>8.2f} MiB/s".format(
+                mb, args.chunk, elapsed, mb / elapsed)
+            storage.close()
+        finally:
+            os.remove(path)
+
+# 落ちた後のイメージをルートから辿り、bitmapとリンク数が辿った結果と合っているか調べる
+def check_image(path):
+    analyzer = Analyzer(path)  # ここでジャーナルが反映される
+    analyzer.summary()
+    c = analyzer.check()
+    analyzer.close()
+    return analyzer.header.replayed, c["reached"], c["orphans"], analyzer.errors
+
+# ファイルの作成、書き込み、削除、リンク、改名をランダムに続ける(killされるまで)
+# burstを指定すると時々その数のファイルを1つのトランザクションで作る
+# (ジャーナルより大きくしてジャーナルを通さずに書く場合を試す)
+def churn(path, seed, interval, defrag_rate=0, burst=0):
+    import logging
+    FuseTest, llfuse = load_fusetest()
+    logging.basicConfig(format='[churn {}] %(message)s'.format(seed))
+    random.seed(seed)
+    ops = FuseTest.Operations(path, writeback_interval=interval, defrag_rate=defrag_rate)
+    if ops.defragger is not None:
+        # 断片化していなくても動かし、ファイルを動かしている途中でもkillされるようにする
+        ops.defragger.threshold = 0
+        ops.defragger.interval = interval
+    ops.init()
+    ctx = llfuse.RequestContext()
+    ctx.uid = os.getuid()
+    ctx.gid = os.getgid()
+    with llfuse.lock:
+        top = ops.mkdir(ROOT_INODE, "churn{}".format(seed), 040755, ctx).st_ino
+    dirs = [top]
+    files = []  # (親のinode, 名前, inode)
+    n = 0
+    while True:
+        n += 1
+        name = "f{}".format(n)
+        r = random.random()
+        with llfuse.lock:
+            if burst and r < 0.01:
+                parent = random.choice(dirs)
+                with ops.contents.operation():
+                    for i in xrange(burst):
+                        inode, _ = ops.create(parent, "{}.{}".format(name, i), 0100644, 0, ctx)
+                        files.append((parent, "{}.{}".format(name, i), inode))
+                ops.fsync(inode, False)
+            elif r < 0.35 or not files:
+                parent = random.choice(dirs)
+                inode, _ = ops.create(parent, name, 0100644, 0, ctx)
+                ops.write(inode, 0, os.urandom(random.randrange(3000)))
+                ops.flush(inode)
+                files.append((parent, name, inode))
+            elif r < 0.45:
+                dirs.append(ops.mkdir(random.choice(dirs), name, 040755, ctx).st_ino)
+            elif r < 0.65:
+                parent, old, inode = files.pop(random.randrange(len(files)))
+                ops.unlink(parent, old)
+                ops.forget([(inode, 1)])
+            elif r < 0.75:
+                parent, old, inode = files.pop(random.randrange(len(files)))
+                new_parent = random.choice(dirs)
+                ops.rename(parent, old, new_parent, name)
+                files.append((new_parent, name, inode))
+            elif r < 0.85:
+                _, _, inode = random.choice(files)
+                parent = random.choice(dirs)
+                ops.link(inode, parent, name)
+                files.append((parent, name, inode))
+            elif r < 0.95:
+                _, _, inode = random.choice(files)
+                ops.write(inode, random.randrange(4096), os.urandom(random.randrange(1, 2048)))
+            else:
+                ops.fsync(random.choice(files)[2], False)
+
+def bench_crash(args):
+    fd, path = tempfile.mkstemp(suffix='.tfs')
+    os.close(fd)
+    failed = 0
+    try:
+        make_image(path, args.inodes, args.blocks, args.journal)
+        for r in xrange(args.rounds):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    churn(path, r, args.interval, int(args.defrag_rate * 2**20), args.burst)
+                finally:
+                    os._exit(1)
+            time.sleep(random.uniform(0, args.max_delay))
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            replayed, reached, orphans, errors = check_image(path)
+            print "round {:>4}: {:>3} transactions replayed, {:>6} inodes, {:>4} orphans, {}".format(
+                r, replayed, reached, orphans, "OK" if not errors else "BROKEN")
+            for e in errors[:10]:
+                print "    " + e
+            if errors:
+                failed += 1
+                if not args.keep_going:
+                    break
+    finally:
+        os.remove(path)
+    print "{} of {} rounds broken".format(failed, r + 1)
+
+class OpsBench(object):
+    """
+    マウントせずにOperationsのハンドラを直接呼ぶベンチマーク
+    カーネルと同じくllfuseのロックを持って1つずつ呼び、呼び出し毎の時間を覚えておく
+    workloadは前のworkloadが作ったファイルを使う、無ければ時間を測らずに作っておく
+    """
+    workloads = ["create", "lookup", "readdir", "seqwrite", "seqread", "randwrite",
+                 "randread", "rename", "unlink"]
+    readdir_batch = 128  # 1回のreaddirで返すエントリ数(カーネルのバッファに入る分)
+    readdir_passes = 10
+    io_size = 4096  # ランダムなread/writeの大きさ
+
+    def __init__(self, ops, llfuse, args):
+        self.ops = ops
+        self.llfuse = llfuse
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.ctx = llfuse.RequestContext()
+        self.ctx.uid = os.getuid()
+        self.ctx.gid = os.getgid()
+        self.ctx.pid = os.getpid()
+        self.latencies = array('d')
+        self.bytes = 0
+        with llfuse.lock:
+            self.dirs = [ops.mkdir(ROOT_INODE, name, 040755, self.ctx).st_ino
+                         for name in ("bulk", "other")]
+        self.files = []  # (親のinode, 名前, inode)
+        self.big = None  # seqwriteで書いた大きなファイルのinode
+
+    # funcを1回呼んで時間を記録する
+    def call(self, func, *args):
+        with self.llfuse.lock:
+            start = time.time()
+            r = func(*args)
+            self.latencies.append(time.time() - start)
+        return r
+
+    # 時間を測らない呼び出し
+    def untimed(self, func, *args):
+        with self.llfuse.lock:
+            return func(*args)
+
+    # nameのworkloadを動かして、回数、スループット、レイテンシの分布、それまでの最大RSSを返す
+    # ops/sとMiB/sはハンドラの中にいた時間だけで割る
+    def run(self, name):
+        self.latencies = array('d')
+        self.bytes = 0
+        getattr(self, "_" + name)()
+        lat = sorted(self.latencies)
+        total = sum(lat) or 1e-9
+        pct = lambda p: lat[min(int(len(lat) * p), len(lat) - 1)] * 1e6 if lat else 0.0
+        return {"ops": len(lat), "ops_s": len(lat) / total,
+                "mib_s": self.bytes / total / 2**20,
+                "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99), "max": pct(1.0),
+                "rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+    # 前のworkloadが作るはずのものを時間を測らずに作る
+    def _prepare(self, name):
+        latencies, nbytes = self.latencies, self.bytes
+        self.latencies = array('d')
+        getattr(self, "_" + name)()
+        self.latencies, self.bytes = latencies, nbytes
+
+    def _open(self, inode):
+        fh = self.untimed(self.ops.open, inode, os.O_RDWR)
+        return getattr(fh, "fh", fh)
+
+    def _create(self):
+        parent = self.dirs[0]
+        for i in xrange(len(self.files), len(self.files) + self.args.files):
+            name = "f{}".format(i)
+            inode, _ = self.call(self.ops.create, parent, name, 0100644, os.O_WRONLY, self.ctx)
+            self.untimed(self.ops.release, inode)
+            self.files.append((parent, name, inode))
+
+    def _lookup(self):
+        if not self.files:
+            self._prepare("create")
+        for parent, name, _ in self.files:
+            self.call(self.ops.lookup, parent, name)
+
+    # 続きは前回返した最後のエントリのoffsetから読む
+    def _readdir(self):
+        if not self.files:
+            self._prepare("create")
+        read = lambda inode, off: list(islice(self.ops.readdir(inode, off), self.readdir_batch))
+        for _ in xrange(self.readdir_passes):
+            for inode in self.dirs:
+                fh = self.untimed(self.ops.opendir, inode)
+                off = 0
+                while True:
+                    entries = self.call(read, fh, off)
+                    if not entries:
+                        break
+                    off = entries[-1][2]
+                self.untimed(self.ops.releasedir, fh)
+
+    def _seqwrite(self):
+        inode, _ = self.untimed(self.ops.create, ROOT_INODE, "big{}".format(time.time()),
+                                0100644, os.O_WRONLY, self.ctx)
+        chunk = os.urandom(self.args.chunk)
+        for off in xrange(0, self.args.size * 2**20, self.args.chunk):
+            self.bytes += self.call(self.ops.write, inode, off, chunk)
+        self.untimed(self.ops.flush, inode)
+        self.untimed(self.ops.release, inode)
+        self.big = inode
+
+    def _seqread(self):
+        if self.big is None:
+            self._prepare("seqwrite")
+        fh = self._open(self.big)
+        for off in xrange(0, self.args.size * 2**20, self.args.chunk):
+            self.bytes += len(self.call(self.ops.read, fh, off, self.args.chunk))
+        self.untimed(self.ops.release, fh)
+
+    def _randwrite(self):
+        if self.big is None:
+            self._prepare("seqwrite")
+        fh = self._open(self.big)
+        data = os.urandom(self.io_size)
+        n = self.args.size * 2**20 / self.io_size
+        for _ in xrange(self.args.count):
+            self.bytes += self.call(self.ops.write, fh, self.random.randrange(n) * self.io_size,
+                                    data)
+        self.untimed(self.ops.flush, fh)
+        self.untimed(self.ops.release, fh)
+
+    def _randread(self):
+        if self.big is None:
+            self._prepare("seqwrite")
+        fh = self._open(self.big)
+        n = self.args.size * 2**20 / self.io_size
+        for _ in xrange(self.args.count):
+            self.bytes += len(self.call(self.ops.read, fh,
+                                        self.random.randrange(n) * self.io_size, self.io_size))
+        self.untimed(self.ops.release, fh)
+
+    # ファイルを2つのディレクトリの間で新しい名前に移し続ける
+    def _rename(self):
+        if not self.files:
+            self._prepare("create")
+        for i in xrange(self.args.count):
+            k = self.random.randrange(len(self.files))
+            parent, name, inode = self.files[k]
+            new_parent = self.random.choice(self.dirs)
+            new_name = "r{}".format(i)
+            self.call(self.ops.rename, parent, name, new_parent, new_name)
+            self.files[k] = (new_parent, new_name, inode)
+
+    # カーネルと同じく、unlinkの後にforgetされてinodeが解放される
+    def _unlink(self):
+        if not self.files:
+            self._prepare("create")
+        for parent, name, inode in self.files:
+            self.call(self.ops.unlink, parent, name)
+            self.untimed(self.ops.forget, [(inode, 1)])
+        self.files = []
+
+
+def bench_ops(args):
+    for name in args.workloads:
+        if name not in OpsBench.workloads:
+            print "bench.py: eroor: unknown workload {}, choose from {}".format(
+                name, " ".join(OpsBench.workloads))
+            return
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    FuseTest, llfuse = load_fusetest(stub=True)
+    block_size = args.block_size or TestFSHeader.block_size
+    # ファイルの中身とディレクトリのエントリが入って、断片化しても余裕がある程度
+    blocks = args.size * 2**20 / block_size * 4 + args.files * 64 / block_size * 4 + 2**14
+    fd, path = tempfile.mkstemp(suffix='.tfs')
+    os.close(fd)
+    try:
+        make_image(path, args.files * 2 + 1024, blocks, args.journal, block_size)
+        ops = FuseTest.Operations(path, args.cache_size * 2**20, writeback_interval=args.interval)
+        ops.init()
+        bench = OpsBench(ops, llfuse, args)
+        results = {}
+        print "{:<10} {:>8} {:>10} {:>8} {:>9} {:>9} {:>9} {:>10} {:>9}{}".format(
+            "workload", "ops", "ops/s", "MiB/s", "p50(us)", "p90(us)", "p99(us)", "max(us)",
+            "rss(MiB)", "" if baseline is None else "  vs base")
+        for name in OpsBench.workloads:
+            if args.workloads and name not in args.workloads:
+                continue
+            r = results[name] = bench.run(name)
+            change = ""
+            if baseline is not None and name in baseline:
+                change = " {:>+8.0%}".format(r["ops_s"] / baseline[name]["ops_s"] - 1)
+            print "{:<10} {:>8} {:>10.0f} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>9.1f}{}".format(
+                name, r["ops"], r["ops_s"], r["mib_s"], r["p50"], r["p90"], r["p99"], r["max"],
+                r["rss_mib"], change)
+        with llfuse.lock:
+            ops.destroy()
+    finally:
+        os.remove(path)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            options = dict((k, v) for k, v in vars(args).iteritems() if k != "func")
+            json.dump({"args": options, "results": results}, f, indent=1, sort_keys=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark testfs internals.')
+    sub = parser.add_subparsers()
+    p = sub.add_parser('alloc', help='Inode and block allocator microbenchmarks.')
+    p.add_argument('-b', '--blocks', type=int, default=2**22,
+                   help='Number of blocks in the image.(default 2**22)')
+    p.add_argument('-i', '--inodes', type=int, default=2**20,
+                   help='Number of inode entries in the image.(default 2**20)')
+    p.add_argument('-n', '--count', type=int, default=100000,
+                   help='Operations per benchmark.(default 100000)')
+    p.set_defaults(func=bench_alloc)
+    p = sub.add_parser('write', help='Sequential write/read of a large file through Blocks.')
+    p.add_argument('sizes', type=int, nargs='*', default=[64, 128, 256],
+                   help='File sizes in MiB.(default 64 128 256)')
+    p.add_argument('-s', '--chunk', type=int, default=4096,
+                   help='Bytes per write/read call.(default 4096)')
+    p.add_argument('-c', '--cache-size', type=int, default=PageCache.default_size / 2**20,
+                   help='Page cache size in MiB.(default {})'.format(PageCache.default_size / 2**20))
+    p.set_defaults(func=bench_write)
+    p = sub.add_parser('crash', help='Kill a process updating the image at random points and check it.')
+    p.add_argument('-r', '--rounds', type=int, default=50,
+                   help='Number of kills.(default 50)')
+    p.add_argument('-b', '--blocks', type=int, default=2**16,
+                   help='Number of blocks in the image.(default 2**16)')
+    p.add_argument('-i', '--inodes', type=int, default=2**14,
+                   help='Number of inode entries in the image.(default 2**14)')
+    p.add_argument('-j', '--journal', type=int, default=2048,
+                   help='Number of journal blocks, 0 disables the journal.(default 2048)')
+    p.add_argument('-w', '--interval', type=float, default=0.05,
+                   help='Seconds between commits in the killed process.(default 0.05)')
+    p.add_argument('-t', '--max-delay', type=float, default=1.0,
+                   help='Longest time before the kill in seconds.(default 1.0)')
+    p.add_argument('-D', '--defrag-rate', type=float, default=0,
+                   help='Run the background defragmenter at this many MiB/s.(default 0)')
+    p.add_argument('-B', '--burst', type=int, default=0,
+                   help='Now and then create this many files in one transaction, '
+                   'make it larger than the journal to test writing around it.(default 0)')
+    p.add_argument('-k', '--keep-going', action='store_true',
+                   help='Continue after a broken image.')
+    p.set_defaults(func=bench_crash)
+    p = sub.add_parser('ops', help='Drive FuseTest.Operations in process through stubllfuse.')
+    p.add_argument('workloads', nargs='*',
+                   help='Workloads to run, always in the order {}.(default all)'.format(
+                       " ".join(OpsBench.workloads)))
+    p.add_argument('-f', '--files', type=int, default=10000,
+                   help='Number of files to create.(default 10000)')
+    p.add_argument('-s', '--size', type=int, default=64,
+                   help='Size of the large file in MiB.(default 64)')
+    p.add_argument('-k', '--chunk', type=int, default=128 * 2**10,
+                   help='Bytes per sequential write/read call.(default 131072)')
+    p.add_argument('-n', '--count', type=int, default=10000,
+                   help='Operations for random read/write and rename.(default 10000)')
+    p.add_argument('-c', '--cache-size', type=int, default=PageCache.default_size / 2**20,
+                   help='Page cache size in MiB.(default {})'.format(PageCache.default_size / 2**20))
+    p.add_argument('-w', '--interval', type=float, default=5,
+                   help='Writeback interval in seconds, 0 commits every write.(default 5)')
+    p.add_argument('-j', '--journal', type=int, default=8192,
+                   help='Number of journal blocks.(default 8192)')
+    p.add_argument('-B', '--block-size', type=int,
+                   help='Block size of the image.(default {})'.format(TestFSHeader.block_size))
+    p.add_argument('-S', '--seed', type=int, default=0, help='Random seed.(default 0)')
+    p.add_argument('-o', '--save', help='Save the results as JSON to compare later.')
+    p.add_argument('-b', '--baseline', help='Show ops/s relative to results saved with -o.')
+    p.set_defaults(func=bench_ops)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+
+import argparse
+import os.path
+from stat import S_ISREG
+from testfs import Storage, TestFSHeader, InodeTable, PageCache, Blocks, Defragmenter, \
+                   NULL_BLOCK
+
+BATCH = 64  # 1つのトランザクションにまとめるファイル数
+
+def report(header):
+    f = header.fragmentation()
+    print "free blocks: {}, largest free run: {} ({:.0%} fragmented)".format(
+        f["free"], f["largest"], f["score"])
+    for size in sorted(f["runs"]):
+        print "  {:>10}+ blocks: {} runs".format(size, f["runs"][size])
+
+# マウント中と同じく、ファイルの中身を書いてからメタデータをジャーナルを通して書く
+def commit(storage, header, table, cache):
+    cache.flush()
+    storage.sync()
+    header.commit(table.deltas() + header.deltas(), cache.pin_meta(), cache)
+
+# 全inodeを1周して動かしたblock数を返す
+def defrag_pass(storage, header, table, cache, defrag):
+    moved = defrag.moved
+    pending = 0
+    while True:
+        inode = defrag.next_inode()
+        if inode is None:
+            break
+        record = table.get(inode)
+        mode, size, datap = record[2], record[6], record[10]
+        if datap == NULL_BLOCK:
+            continue
+        blocks = Blocks(header, cache, datap, size, not S_ISREG(mode))
+        if defrag.relocate(blocks):
+            blocks.flush()
+            table.put(inode, record[:10] + (blocks.head, record[11]))
+            pending += 1
+            if pending >= BATCH:
+                commit(storage, header, table, cache)
+                pending = 0
+    commit(storage, header, table, cache)
+    return defrag.moved - moved
+
+def main():
+    parser = argparse.ArgumentParser(description='Defragment testfs data file.')
+    parser.add_argument('file', help='Path to testfs data file.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only show how fragmented the free space is.')
+    parser.add_argument('-p', '--passes', type=int, default=8,
+                        help='Maximum number of passes over all inodes.(default 8)')
+    parser.add_argument('-c', '--cache-size', type=int, default=PageCache.default_size / 2**20,
+                        help='Page cache size in MiB.(default {})'.format(PageCache.default_size / 2**20))
+    args = parser.parse_args()
+    if not os.path.isfile(args.file):
+        parser.print_usage()
+        print "defragtestfs.py: eroor: {} is not file".format(args.file)
+        return
+    storage = Storage(args.file)
+    header = TestFSHeader(storage)
+    report(header)
+    if not args.dry_run:
+        table = InodeTable(header)
+        cache = PageCache(header, args.cache_size * 2**20 / header.block_size)
+        defrag = Defragmenter(header)
+        # 1周の間に空いたblockはコミットするまで使えないので、動かなくなるまで繰り返す
+        for _ in xrange(args.passes):
+            if defrag_pass(storage, header, table, cache, defrag) == 0:
+                break
+        header.journal.checkpoint()
+        print "moved {} blocks of {} files".format(defrag.moved, defrag.files)
+        report(header)
+    storage.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,282 @@
 #!/usr/bin/env python2
+# -*- coding:utf-8 -*-
 
-import struct
 import os.path
+import sys
 import argparse
+from array import array
+from collections import defaultdict
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from testfs import TestFSHeader, PageCache, Blocks, Directory, Bitmap, \
+                   HEADER_STRUCT, CONTENT_STRUCT, NULL_BLOCK, ROOT_INODE
 
-def count_bits(n):
-    s = 0
-    while n != 0:
-        if (n & 1 == 1):
-            s += 1
-        n = n >> 1
-    return s
+CHUNK = 2**20  # bitmapとinodeエントリを1回に読む大きさ(byte)
+ONE_BITS = "".join(chr(bin(i).count("1")) for i in xrange(256))  # byte中の1の数
+
+# 1のbit数、byte毎にtranslateで1の数にしてまとめて足す
+def popcount(data):
+    return sum(bytearray(data).translate(ONE_BITS))
+
+class Analyzer(object):
+    """
+    マウントせずにイメージ全体を調べる
+    bitmapはディスク上のものをCHUNKずつbyte単位で数え、inodeエントリもCHUNKずつ読む
+    検査で覚えておくのはblock数とinode数に比例するbitmapと数の配列だけで、
+    ファイルやblock毎にPythonのオブジェクトを作らないので大きなイメージでもメモリは抑えられる
+    """
+    def __init__(self, path, max_errors=None):
+        # マウントと同じくジャーナルに残っている分を反映するが、イメージには書かない
+        self.header = TestFSHeader.open_readonly(path)
+        self.storage = self.header.storage
+        self.cache = PageCache(self.header, 256)  # extent mapとディレクトリを読むのに使うだけ
+        self.max_errors = max_errors  # これを超えた分は数えるだけ
+        self.errors = []
+        self.error_count = 0
+
+    def close(self):
+        self.storage.close()
+
+    def error(self, message):
+        self.error_count += 1
+        if self.max_errors is None or len(self.errors) < self.max_errors:
+            self.errors.append(message)
+
+    # ディスク上のbitmapの使用中のbit数、最後のbyteの余りのbitは0のはず
+    def count_bitmap(self, head, length):
+        nbytes = (length - 1) / 8 + 1
+        used = 0
+        for off in xrange(0, nbytes, CHUNK):
+            used += popcount(self.storage.view(head + off, min(CHUNK, nbytes - off)))
+        tail = ord(self.storage.view(head + nbytes - 1, 1)[0])
+        if length % 8 != 0 and tail & (0xff >> (length % 8)):
+            self.error("bitmap at {} has bits set beyond {}".format(head, length))
+        return used
+
+    # ヘッダの内容、bitmapの使用数と空き領域の断片化
+    def summary(self):
+        header = self.header
+        _, _, free_ino, free_blk, _, _ = self.storage.unpack(HEADER_STRUCT, 0)
+        used_ino = self.count_bitmap(header.ino_status_head, header.max_ino)
+        used_blk = self.count_bitmap(header.blk_status_head, header.max_blk)
+        if header.max_ino - used_ino != free_ino:
+            self.error("header says {} free inodes but bitmap has {}".format(
+                free_ino, header.max_ino - used_ino))
+        if header.max_blk - used_blk != free_blk:
+            self.error("header says {} free blocks but bitmap has {}".format(
+                free_blk, header.max_blk - used_blk))
+        return {"inodes": header.max_ino, "used_inodes": used_ino,
+                "blocks": header.max_blk, "used_blocks": used_blk,
+                "block_size": header.block_size, "journal": header.journal_blocks,
+                "replayed": header.replayed, "free_space": header.fragmentation()}
+
+    # datapから辿った(extentのリスト, extent mapのblockのリスト)、壊れていればNone
+    # Blocksと違って範囲外やループしたmapでも止まる
+    def extents(self, inode, datap):
+        header = self.header
+        per_block = (header.block_size - Blocks.map_struct.size) / Blocks.extent_struct.size
+        extents = []
+        maps = []
+        index = datap
+        while index != NULL_BLOCK:
+            if index >= header.max_blk or len(maps) >= header.max_blk:
+                self.error("inode {} points to extent map block {}".format(inode, index))
+                return None
+            d = self.cache.get(index)
+            count, index_next = Blocks.map_struct.unpack_from(d)
+            if count > per_block:
+                self.error("extent map block {} of inode {} has {} extents".format(
+                    index, inode, count))
+                return None
+            for i in xrange(count):
+                start, length = Blocks.extent_struct.unpack_from(
+                    d, Blocks.map_struct.size + i * Blocks.extent_struct.size)
+                if length == 0 or start + length > header.max_blk:
+                    self.error("inode {} has extent ({}, {})".format(inode, start, length))
+                    return None
+                extents.append((start, length))
+            maps.append(index)
+            index = index_next
+        return extents, maps
+
+    # inodeエントリを全部読んでblockの持ち主を調べ、ファイルの断片化を数える
+    # ownedに持ち主のいるblock、nlinkとmodesに各inodeのリンク数とモードを入れる
+    def check_inodes(self, owned, nlink, modes):
+        header = self.header
+        stats = {"files": 0, "directories": 0, "symlinks": 0, "inline": 0, "extents": 0,
+                 "fragmented": 0, "max_extents": 0, "owned_free": 0}
+        histogram = defaultdict(int)  # extent数(2の冪に切り下げ) -> inode数
+        per_chunk = CHUNK / CONTENT_STRUCT.size
+        for first in xrange(0, header.max_ino, per_chunk):
+            n = min(per_chunk, header.max_ino - first)
+            records = self.storage.view(header.content_index2address(first),
+                                        n * CONTENT_STRUCT.size)
+            for i in xrange(n):
+                if not header.ino_status.get(first + i):
+                    continue
+                inode = first + i + ROOT_INODE
+                record = CONTENT_STRUCT.unpack_from(records, i * CONTENT_STRUCT.size)
+                mode, size, datap = record[2], record[6], record[10]
+                nlink[first + i] = record[3]
+                modes[first + i] = mode
+                if record[0] != inode:
+                    self.error("inode {} has st_ino {}".format(inode, record[0]))
+                if S_ISDIR(mode):
+                    stats["directories"] += 1
+                elif S_ISLNK(mode):
+                    stats["symlinks"] += 1
+                elif S_ISREG(mode):
+                    stats["files"] += 1
+                else:
+                    self.error("inode {} has mode {:o}".format(inode, mode))
+                if datap == NULL_BLOCK:
+                    if S_ISDIR(mode) and size != 0 or size > len(record[11]):
+                        self.error("inode {} has size {} but no blocks".format(inode, size))
+                    stats["inline"] += not S_ISDIR(mode) and size > 0
+                    continue
+                r = self.extents(inode, datap)
+                if r is None:
+                    continue
+                extents, maps = r
+                total = sum(length for _, length in extents)
+                if size > total * header.block_size:
+                    self.error("inode {} has size {} but {} blocks".format(inode, size, total))
+                for start, length in extents + [(m, 1) for m in maps]:
+                    free = length - header.blk_status.used(start, length)
+                    if free:
+                        self.error("{} blocks from {} of inode {} are free".format(
+                            free, start, inode))
+                        stats["owned_free"] += free
+                    shared = owned.used(start, length)
+                    if shared:
+                        self.error("{} blocks from {} of inode {} are already owned".format(
+                            shared, start, inode))
+                        for b in xrange(start, start + length):
+                            if not owned.get(b):
+                                owned.set_range(b, 1)
+                    else:
+                        owned.set_range(start, length)
+                stats["extents"] += len(extents)
+                stats["max_extents"] = max(stats["max_extents"], len(extents))
+                stats["fragmented"] += len(extents) > 1
+                if extents:
+                    histogram[1 << (len(extents).bit_length() - 1)] += 1
+        stats["histogram"] = dict(histogram)
+        return stats
+
+    # ルートからディレクトリを辿って各inodeを指すエントリを数え、辿れたinodeに印を付ける
+    # 覚えておくのは辿る途中のディレクトリのinode番号と、今読んでいるディレクトリの中身だけ
+    def check_tree(self, refs, reached, modes):
+        header = self.header
+        if not header.is_usedino(ROOT_INODE):
+            # ルートは最初にマウントした時に作るので、作ったばかりのイメージには無い
+            if header.free_inodes != header.max_ino:
+                self.error("root inode is free")
+            return
+        reached.set_range(0, 1)
+        stack = array("L", [ROOT_INODE])
+        while stack:
+            inode = stack.pop()
+            record = self.storage.unpack(CONTENT_STRUCT,
+                                         header.content_index2address(inode - ROOT_INODE))
+            if record[10] == NULL_BLOCK or self.extents(inode, record[10]) is None:
+                continue
+            d = Directory(Blocks(header, self.cache, record[10], record[6]))
+            try:
+                d.load()
+            except (IOError, ValueError) as e:
+                self.error("directory {} is broken: {}".format(inode, e))
+                continue
+            for name, child in d.children.iteritems():
+                i = child - ROOT_INODE
+                if not 0 <= i < header.max_ino or not header.ino_status.get(i):
+                    self.error("entry {!r} in directory {} points to free inode {}".format(
+                        name, inode, child))
+                    continue
+                refs[i] += 1
+                if not reached.get(i):
+                    reached.set_range(i, 1)
+                    if S_ISDIR(modes[i]):
+                        stack.append(child)
+
+    # inodeエントリとディレクトリをbitmapと突き合わせて統計を返す、不整合はerrorsに入る
+    def check(self):
+        header = self.header
+        owned = Bitmap(bytearray((header.max_blk - 1) / 8 + 1), header.max_blk)
+        reached = Bitmap(bytearray((header.max_ino - 1) / 8 + 1), header.max_ino)
+        nlink = array("L", [0]) * header.max_ino
+        refs = array("L", [0]) * header.max_ino
+        modes = array("L", [0]) * header.max_ino
+        stats = self.check_inodes(owned, nlink, modes)
+        self.check_tree(refs, reached, modes)
+        # unlinkされてforgetされる前に落ちたinodeは残っていてよい
+        orphans = 0
+        for i in xrange(header.max_ino):
+            if not header.ino_status.get(i):
+                continue
+            if not reached.get(i):
+                if nlink[i] != 0:
+                    self.error("inode {} is used but not linked".format(i + ROOT_INODE))
+                orphans += 1
+            elif nlink[i] != refs[i]:
+                self.error("inode {} has nlink {} but {} entries".format(
+                    i + ROOT_INODE, nlink[i], refs[i]))
+        # 使用中なのに誰も持っていないblock(持ち主がいるのに空いているものは報告済み)
+        leaked = (header.max_blk - header.free_blocks) - \
+                 (header.max_blk - owned.free - stats.pop("owned_free"))
+        if leaked != 0:
+            self.error("{} blocks are used but not owned".format(leaked))
+        stats.update({"reached": header.max_ino - reached.free, "orphans": orphans,
+                      "leaked": leaked})
+        return stats
+
+
+def print_runs(runs, unit):
+    for size in sorted(runs):
+        print "  {:>10}+ {}: {}".format(size, unit, runs[size])
 
 def main():
     parser = argparse.ArgumentParser(description='Dump testfs infomation.')
     parser.add_argument('file', help='Path to testfs data file.')
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='Check inode entries and directories against the bitmaps.')
+    parser.add_argument('-m', '--max-errors', type=int, default=100,
+                        help='Maximum number of errors to show.(default 100)')
     args = parser.parse_args()
     if not os.path.isfile(args.file):
         parser.print_usage()
         print "dumptestfs.py: eroor: {} is not file".format(args.file)
         return
-    s = struct.Struct('2I')
-    with open(args.file, 'rb') as f:
-        inodes, blocks = s.unpack(f.read(s.size))
-        inode_bytes = (inodes-1)/8+1
-        blk_bytes = (blocks-1)/8+1
-        inode_entries = struct.unpack("{}B".format(inode_bytes), f.read(inode_bytes))
-        blk_entries = struct.unpack("{}B".format(blk_bytes), f.read(blk_bytes))
-    inode_used =sum([count_bits(i) for i in inode_entries])
-    blk_used = sum([count_bits(i) for i in blk_entries])
-    print "inode entries: {} total, {} used, {} free".format(inodes, inode_used, inodes - inode_used)
-    print "blocks: {} total, {} used, {} free".format(blocks, blk_used, blocks - blk_used)
+    analyzer = Analyzer(args.file, args.max_errors)
+    try:
+        s = analyzer.summary()
+        inodes, blocks = s["inodes"], s["blocks"]
+        print "inode entries: {} total, {} used, {} free".format(
+            inodes, s["used_inodes"], inodes - s["used_inodes"])
+        print "blocks: {} total, {} used, {} free".format(
+            blocks, s["used_blocks"], blocks - s["used_blocks"])
+        print "block size: {} bytes, {} bytes total".format(s["block_size"],
+                                                            blocks * s["block_size"])
+        print "journal: {} blocks, {} transactions replayed".format(s["journal"], s["replayed"])
+        f = s["free_space"]
+        print "free space: largest run {} blocks ({:.0%} fragmented)".format(
+            f["largest"], f["score"])
+        print_runs(f["runs"], "blocks")
+        if args.check:
+            c = analyzer.check()
+            print "{} files, {} directories, {} symlinks, {} inline, {} reachable, {} orphans".format(
+                c["files"], c["directories"], c["symlinks"], c["inline"], c["reached"],
+                c["orphans"])
+            print "extents: {} total, {} fragmented inodes, at most {} in one inode".format(
+                c["extents"], c["fragmented"], c["max_extents"])
+            print_runs(c["histogram"], "extents")
+        for message in analyzer.errors:
+            print message
+        if analyzer.error_count:
+            print "{} errors".format(analyzer.error_count)
+    finally:
+        analyzer.close()
+    if analyzer.error_count:
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
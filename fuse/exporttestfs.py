@@ -0,0 +1,210 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+
+import argparse
+import os
+import os.path
+import sys
+import tarfile
+from stat import S_ISDIR, S_ISLNK, S_IMODE
+from testfs import TestFSHeader, PageCache, Blocks, Directory, \
+                   CONTENT_STRUCT, NULL_BLOCK, ROOT_INODE
+
+CHUNK = 2**20  # ファイルの中身を1回に読む大きさ
+
+class Image(object):
+    """
+    マウントせずにイメージの中身を読む
+    inodeエントリは使う分だけ読み(InodeTableのように全部は読まない)、中身はBlocksで
+    連続したblockをまとめて読むので、メモリは一番大きいディレクトリの分くらいしか使わない
+    """
+    def __init__(self, path):
+        # ジャーナルに残っている分はメモリ上だけで反映し、イメージには書かない
+        self.header = TestFSHeader.open_readonly(path)
+        self.storage = self.header.storage
+        self.cache = PageCache(self.header, 256)  # extent mapを読むのに使うだけ
+
+    def close(self):
+        self.storage.close()
+
+    # inodeエントリ(Content構造体の並び)
+    def record(self, inode):
+        if not self.header.is_usedino(inode):
+            raise KeyError(inode)
+        address = self.header.content_index2address(inode - ROOT_INODE)
+        return self.storage.unpack(CONTENT_STRUCT, address)
+
+    def open(self, record):
+        return ContentReader(self, record)
+
+    def children(self, record):
+        d = Directory(Blocks(self.header, self.cache, record[10], record[6]))
+        d.load()
+        return d.children
+
+    # イメージ内の絶対パスからinode番号
+    def lookup(self, path):
+        inode = ROOT_INODE
+        for name in path.split("/"):
+            if not name:
+                continue
+            record = self.record(inode)
+            if not S_ISDIR(record[2]):
+                raise KeyError(path)
+            inode = self.children(record)[name]
+        return inode
+
+    # inodeから下を親が先になる順に(名前, inode, inodeエントリ)で返す、名前はnameからの相対パス
+    def walk(self, inode, name):
+        stack = [(name, inode)]
+        while stack:
+            name, inode = stack.pop()
+            record = self.record(inode)
+            yield name, inode, record
+            if S_ISDIR(record[2]):
+                children = self.children(record)
+                for child in sorted(children, reverse=True):
+                    if child not in (".", ".."):
+                        stack.append((os.path.join(name, child), children[child]))
+
+
+class ContentReader(object):
+    """
+    1つのinodeの中身を頭から読むファイルのようなもの
+    readが小さくてもBlocksからはCHUNKずつまとめて読む
+    """
+    def __init__(self, image, record):
+        mode, size, datap, inline = record[2], record[6], record[10], record[11]
+        self.size = size
+        self.pos = 0  # 次にBlocksから読む位置
+        self.blocks = None
+        self.buf = ""
+        self.off = 0  # bufの中で次に返す位置
+        if not S_ISDIR(mode) and datap == NULL_BLOCK:
+            self.buf = inline[:size]
+            self.pos = size
+        else:
+            self.blocks = Blocks(image.header, image.cache, datap, size)
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.off == len(self.buf):
+                if self.pos >= self.size:
+                    break
+                self.buf = self.blocks.read(self.pos, min(CHUNK, self.size - self.pos))
+                self.off = 0
+                self.pos += len(self.buf)
+            n = len(self.buf) - self.off if size < 0 else min(size, len(self.buf) - self.off)
+            pieces.append(self.buf[self.off:self.off+n])
+            self.off += n
+            if size > 0:
+                size -= n
+        return "".join(pieces)
+
+
+def export_tar(image, inode, name, out, compress):
+    tar = tarfile.open(fileobj=out, mode="w|gz" if compress else "w|")
+    links = {}  # 2つ以上の名前があるinode -> 最初に書いた名前
+    for path, inode, record in image.walk(inode, name):
+        mode, nlink, uid, gid, size, mtime = (record[2], record[3], record[4], record[5],
+                                              record[6], record[8])
+        info = tarfile.TarInfo(path)
+        info.mode = S_IMODE(mode)
+        info.uid = uid
+        info.gid = gid
+        info.mtime = mtime
+        f = None
+        if S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+        elif S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = image.open(record).read()
+        elif inode in links:
+            info.type = tarfile.LNKTYPE
+            info.linkname = links[inode]
+        else:
+            if nlink > 1:
+                links[inode] = path
+            info.size = size
+            f = image.open(record)
+        tar.addfile(info, f)
+    tar.close()
+
+def export_dir(image, inode, name, dest):
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    links = {}
+    dirs = []  # 中身を書き終えてから時刻を戻すディレクトリ
+    for path, inode, record in image.walk(inode, name):
+        mode, nlink, uid, gid, atime, mtime = (record[2], record[3], record[4], record[5],
+                                               record[7], record[8])
+        target = os.path.join(dest, path)
+        if S_ISDIR(mode):
+            if not os.path.isdir(target):
+                os.mkdir(target)
+            dirs.append((target, record))
+            continue
+        if S_ISLNK(mode):
+            os.symlink(image.open(record).read(), target)
+        elif inode in links:
+            os.link(links[inode], target)
+            continue
+        else:
+            if nlink > 1:
+                links[inode] = target
+            f = image.open(record)
+            with open(target, "wb") as out:
+                while True:
+                    d = f.read(CHUNK)
+                    if not d:
+                        break
+                    out.write(d)
+        set_attrs(target, record)
+    for target, record in reversed(dirs):
+        set_attrs(target, record)
+
+def set_attrs(target, record):
+    mode, uid, gid, atime, mtime = record[2], record[4], record[5], record[7], record[8]
+    if os.geteuid() == 0:
+        os.lchown(target, uid, gid)
+    if not S_ISLNK(mode):
+        os.chmod(target, S_IMODE(mode))
+        os.utime(target, (atime, mtime))
+
+def main():
+    parser = argparse.ArgumentParser(description='Export files from testfs data file without mounting.')
+    parser.add_argument('file', help='Path to testfs data file.')
+    parser.add_argument('-p', '--path', default='/',
+                        help='Path in the image to export.(default /)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Write a tar archive to this file, - is stdout.(default -)')
+    parser.add_argument('-z', '--gzip', action='store_true', help='Compress the tar archive.')
+    parser.add_argument('-x', '--extract',
+                        help='Extract into this directory instead of writing a tar archive.')
+    args = parser.parse_args()
+    if not os.path.isfile(args.file):
+        parser.print_usage()
+        print >>sys.stderr, "exporttestfs.py: eroor: {} is not file".format(args.file)
+        return
+    image = Image(args.file)
+    try:
+        try:
+            inode = image.lookup(args.path)
+        except KeyError:
+            print >>sys.stderr, "exporttestfs.py: eroor: {} is not found in the image".format(args.path)
+            return
+        # 中身は書き出し先からの相対パスにする、ルートなら"."
+        name = os.path.basename(args.path.rstrip("/")) or "."
+        if args.extract is not None:
+            export_dir(image, inode, name, args.extract)
+        elif args.output == '-':
+            export_tar(image, inode, name, sys.stdout, args.gzip)
+        else:
+            with open(args.output, 'wb') as out:
+                export_tar(image, inode, name, out, args.gzip)
+    finally:
+        image.close()
+
+if __name__ == '__main__':
+    main()
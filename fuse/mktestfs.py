@@ -1,31 +1,254 @@
 #!/usr/bin/env python2
+# -*- coding:utf-8 -*-
 
 import argparse
-import struct
+import os
 import os.path
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+from testfs import Storage, TestFSHeader, InodeTable, Blocks, Directory, \
+                   CONTENT_STRUCT, NULL_BLOCK, INLINE_SIZE, ROOT_INODE
 
 DEFAULT_INODE=1024
+MAX_INODE=2**32-1  # inode番号はinodeエントリ、ディレクトリのレコード共に32bit
+DEFAULT_JOURNAL=4*2**20  # byte、blockの大きさで割ってblock数にする
+CHUNK = 2**20  # ファイルをコピーする時の1回のread/writeの大きさ
 
 def calk_blksize():
     return 2**20
 
+# 指定が無い時のジャーナルのblock数、DEFAULT_JOURNAL byte分でデータ領域の1/8を超えないようにする
+def calk_journal(blocks, block_size):
+    return max(min(DEFAULT_JOURNAL / block_size, blocks / 8), 2)
+
+# pathの中身を名前順に(名前, パス, lstat)で返す、testfsに作れない種類のファイルは飛ばす
+def listing(path, verbose=True):
+    entries = []
+    for name in sorted(os.listdir(path)):
+        child = os.path.join(path, name)
+        st = os.lstat(child)
+        if not (S_ISDIR(st.st_mode) or S_ISREG(st.st_mode) or S_ISLNK(st.st_mode)) \
+           or len(name) > 255:
+            if verbose:
+                print "mktestfs.py: skipped {}".format(child)
+            continue
+        entries.append((name, child, st))
+    return entries
+
+class ImageBuilder(object):
+    """
+    ホストのディレクトリツリーを空のイメージに書き込む
+    inode番号とblockは辿った順に前から振り、中身はextent 1つの連続した領域に、
+    そのextent mapを直後のblockに置いて(デフラグした後と同じ形)、大きなwriteでそのまま書く
+    ジャーナルもPageCacheも通さず、最後にinodeエントリとbitmapとヘッダをまとめて書く
+    """
+    def __init__(self, storage, block_size=TestFSHeader.block_size):
+        self.storage = storage
+        self.block_size = block_size
+        self.header = None
+        self.table = None
+        self.next_ino = ROOT_INODE
+        self.next_block = 0
+        self.links = {}  # (st_dev, st_ino) -> inode、ハードリンクは同じinodeにする
+        self.nlink = {}  # ハードリンクされたinode -> 見つけた名前の数
+        self.files = 0
+        self.bytes = 0
+
+    # 中身の大きさからblock数(extent mapを含む)、inlineに入るなら0
+    def blocks_for(self, size, is_dir):
+        if not is_dir and size <= INLINE_SIZE:
+            return 0
+        return (size - 1) / self.block_size + 2 if size > 0 else 0
+
+    # 書かずに辿って、要るinode数とblock数を返す
+    def measure(self, source):
+        inodes = 1
+        blocks = 0
+        seen = set()
+        stack = [(source, True)]
+        while stack:
+            path, is_root = stack.pop()
+            entries = listing(path, False)
+            size = len(Directory.record(".", 0)) + (0 if is_root else len(Directory.record("..", 0)))
+            for name, child, st in entries:
+                size += len(Directory.record(name, 0))
+                if S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                inodes += 1
+                if S_ISDIR(st.st_mode):
+                    stack.append((child, False))
+                elif S_ISLNK(st.st_mode):
+                    blocks += self.blocks_for(len(os.readlink(child)), False)
+                else:
+                    blocks += self.blocks_for(st.st_size, False)
+            blocks += self.blocks_for(size, True)
+        return inodes, blocks
+
+    # sourceの中身をルートとして書く
+    def build(self, source):
+        self.header = TestFSHeader(self.storage)
+        self.table = InodeTable(self.header)
+        stack = [(source, self._new_inode(), None)]  # (パス, inode, 親のinode)
+        while stack:
+            path, inode, parent = stack.pop()
+            # ルートには".."を置かない(マウントして作った時と同じ)
+            entries = [(".", inode)] if parent is None else [(".", inode), ("..", parent)]
+            subdirs = []
+            files = []
+            for name, child, st in listing(path):
+                key = (st.st_dev, st.st_ino)
+                if S_ISDIR(st.st_mode):
+                    c = self._new_inode()
+                    subdirs.append((child, c, inode))
+                elif key in self.links:
+                    c = self.links[key]
+                    self.nlink[c] += 1
+                else:
+                    c = self._new_inode()
+                    if S_ISREG(st.st_mode) and st.st_nlink > 1:
+                        self.links[key] = c
+                        self.nlink[c] = 1
+                    files.append((child, c, st))
+                entries.append((name, c))
+            data = "".join(Directory.record(name, c) for name, c in entries)
+            # "."と親からのエントリ(ルートは"."だけ)と、子ディレクトリの".."の数
+            nlink = (1 if parent is None else 2) + len(subdirs)
+            self._put_data(inode, os.lstat(path), nlink, data)
+            for child, c, st in files:
+                if S_ISLNK(st.st_mode):
+                    self._put_data(c, st, 1, os.readlink(child))
+                else:
+                    self._put_file(c, st, child)
+            stack.extend(reversed(subdirs))
+        self._finish()
+
+    def _new_inode(self):
+        if self.next_ino - ROOT_INODE >= self.header.max_ino:
+            raise IOError("All inode entries are used.")
+        self.next_ino += 1
+        return self.next_ino - 1
+
+    # 中身がsize byteのinodeのblockを前から取り、先頭のblock indexを返す
+    def _reserve(self, size):
+        start = self.next_block
+        self.next_block += self.blocks_for(size, True)
+        if self.next_block > self.header.max_blk:
+            raise IOError("No space is avilable.")
+        return start
+
+    # [start, start+size)の中身を指すextent mapを直後のblockに書いて、そのindexを返す
+    def _map(self, start, size):
+        n = (size - 1) / self.block_size + 1
+        d = Blocks.map_struct.pack(1, NULL_BLOCK) + Blocks.extent_struct.pack(start, n)
+        self.storage.write(self.header.block_index2address(start + n), d)
+        return start + n
+
+    def _record(self, inode, st, nlink, size, datap, inline=""):
+        self.table.put(inode, (inode, 0, st.st_mode, nlink, st.st_uid, st.st_gid, size,
+                               int(st.st_atime), int(st.st_mtime), int(st.st_ctime),
+                               datap, inline))
+
+    def _put_data(self, inode, st, nlink, data):
+        if self.blocks_for(len(data), S_ISDIR(st.st_mode)) == 0:
+            self._record(inode, st, nlink, len(data), NULL_BLOCK, data)
+            return
+        start = self._reserve(len(data))
+        self.storage.write(self.header.block_index2address(start), data)
+        self._record(inode, st, nlink, len(data), self._map(start, len(data)))
+
+    # ファイルはCHUNKずつ読んでそのまま書く
+    def _put_file(self, inode, st, path):
+        size = st.st_size
+        self.files += 1
+        self.bytes += size
+        if self.blocks_for(size, False) == 0:
+            with open(path, 'rb') as f:
+                self._put_data(inode, st, 1, f.read(size))
+            return
+        start = self._reserve(size)
+        address = self.header.block_index2address(start)
+        # 読んでいる間に伸びた分は捨て、縮んだ分はゼロのまま(空きのblockはゼロ)
+        with open(path, 'rb') as f:
+            copied = 0
+            while copied < size:
+                d = f.read(min(CHUNK, size - copied))
+                if not d:
+                    break
+                self.storage.write(address + copied, d)
+                copied += len(d)
+        self._record(inode, st, 1, size, self._map(start, size))
+
+    def _finish(self):
+        header = self.header
+        for inode, nlink in self.nlink.iteritems():
+            record = list(self.table.get(inode))
+            record[3] = nlink
+            self.table.put(inode, tuple(record))
+        header.ino_status.set_range(0, self.next_ino - ROOT_INODE)
+        header.blk_status.set_range(0, self.next_block)
+        header.flush()
+        used = (self.next_ino - ROOT_INODE) * CONTENT_STRUCT.size
+        self.storage.write(header.content_head, self.table.records[:used])
+        self.table.dirty.clear()
+        self.storage.sync()
+
 def main():
     parser = argparse.ArgumentParser(description='Initialize testfs data file.')
     parser.add_argument('file', help='Path to testfs data file.')
     parser.add_argument('-b', '--blocks', type=int, help='Specify number of blocks.')
-    parser.add_argument('-i', '--inodes', type=int, default=DEFAULT_INODE,
-                        help='Specify number of inode entries.(default {})'.format(DEFAULT_INODE))
+    parser.add_argument('-i', '--inodes', type=int,
+                        help='Specify number of inode entries, at most {}.(default {})'.format(
+                            MAX_INODE, DEFAULT_INODE))
+    parser.add_argument('-B', '--block-size', type=int, default=TestFSHeader.block_size,
+                        help='Specify block size in bytes, a power of 2 from 512 to 65536.(default {})'.format(TestFSHeader.block_size))
+    parser.add_argument('-j', '--journal-blocks', type=int,
+                        help='Specify number of journal blocks, 0 disables the journal.'
+                        '(default {} bytes worth, at most 1/8 of the blocks)'.format(DEFAULT_JOURNAL))
+    parser.add_argument('-s', '--source',
+                        help='Copy this directory tree into the image as its root.')
     args = parser.parse_args()
     if not os.path.isfile(args.file):
         parser.print_usage()
         print "mktestfs.py: eroor: {} is not file".format(args.file)
         return
+    if not TestFSHeader.valid_block_size(args.block_size):
+        parser.print_usage()
+        print "mktestfs.py: eroor: block size {} is not a power of 2 from 512 to 65536".format(
+            args.block_size)
+        return
+    if args.inodes is not None and not 0 < args.inodes <= MAX_INODE:
+        parser.print_usage()
+        print "mktestfs.py: eroor: number of inodes must be from 1 to {}".format(MAX_INODE)
+        return
     blocks = (args.blocks or calk_blksize())
-    d = struct.pack("2I", args.inodes, blocks)
-    with open(args.file, 'wb') as f:
-        f.write(d)
-        f.write(b"\x00"*args.inodes)
-        f.write(b"\x00"*blocks)
+    inodes = (args.inodes or DEFAULT_INODE)
+    if args.source is not None:
+        if not os.path.isdir(args.source):
+            parser.print_usage()
+            print "mktestfs.py: eroor: {} is not directory".format(args.source)
+            return
+        # 数が指定されていなければ、後から書き足せるように中身の倍は取る
+        need_inodes, need_blocks = ImageBuilder(None, args.block_size).measure(args.source)
+        if args.inodes is None:
+            inodes = min(max(inodes, need_inodes * 2), MAX_INODE)
+        if args.blocks is None:
+            blocks = max(blocks, need_blocks * 2)
+        if inodes < need_inodes or blocks < need_blocks:
+            print "mktestfs.py: eroor: {} needs {} inodes and {} blocks".format(
+                args.source, need_inodes, need_blocks)
+            return
+    journal = args.journal_blocks
+    if journal is None:
+        journal = calk_journal(blocks, args.block_size)
+    TestFSHeader.create(args.file, inodes, blocks, journal, args.block_size)
+    if args.source is not None:
+        storage = Storage(args.file)
+        builder = ImageBuilder(storage, args.block_size)
+        builder.build(args.source)
+        storage.close()
+        print "{} files, {} bytes, {} inodes, {} blocks".format(
+            builder.files, builder.bytes, builder.next_ino - ROOT_INODE, builder.next_block)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
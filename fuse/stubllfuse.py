@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+"""
+llfuseの代わり、マウントせずにOperationsのハンドラを直接呼ぶためのもの
+FuseTestが使う名前だけを用意し、カーネルとは何もやりとりしないので/dev/fuseが無くても動く
+bench.pyがsys.modulesの"llfuse"をこれに差し替えてからFuseTestを読み込む
+"""
+
+import threading
+
+ROOT_INODE = 1
+
+class FUSEError(Exception):
+    def __init__(self, errno):
+        super(FUSEError, self).__init__(errno)
+        self.errno = errno
+
+class EntryAttributes(object):
+    __slots__ = ["st_ino", "generation", "entry_timeout", "attr_timeout", "st_mode",
+                 "st_nlink", "st_uid", "st_gid", "st_rdev", "st_size", "st_blksize",
+                 "st_blocks", "st_atime", "st_mtime", "st_ctime"]
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+class StatvfsData(object):
+    __slots__ = ["f_bsize", "f_frsize", "f_blocks", "f_bfree", "f_bavail", "f_files",
+                 "f_ffree", "f_favail", "f_namemax"]
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+class RequestContext(object):
+    def __init__(self):
+        self.uid = 0
+        self.gid = 0
+        self.pid = 0
+        self.umask = 0
+
+class Operations(object):
+    pass
+
+class _LockReleased(object):
+    """
+    本物と同じく、グローバルロックを持っている呼び出し側から一時的に外す
+    """
+    def __enter__(self):
+        lock.release()
+
+    def __exit__(self, *exc):
+        lock.acquire()
+
+# 本物ではllfuseがハンドラを呼ぶ間持っているロック、ここでは呼び出し側が持つ
+lock = threading.RLock()
+lock_released = _LockReleased()
+
+# カーネルのキャッシュは無いので捨てるものも無い
+def invalidate_inode(inode, attr_only=False):
+    pass
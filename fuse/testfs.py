@@ -0,0 +1,1207 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+
+# testfsのディスク上の構造を扱う部分、llfuseに依存しない
+
+from collections import defaultdict
+from stat import S_ISREG
+import os
+import mmap
+import struct
+import re
+import threading
+import zlib
+import io
+import Queue
+from bisect import bisect_right
+
+ROOT_INODE = 1
+NULL_BLOCK = 0xffffffffffffffff  # 指すblockが無いことを表すblock index
+INLINE_SIZE = 64  # inodeエントリの中に置ける中身の大きさ
+CONTENT_STRUCT = struct.Struct("6I5Q{}s".format(INLINE_SIZE))  # ディスク上のinodeエントリ
+# (inodeエントリ数, block数, 空きinode数, 空きblock数, ジャーナルのblock数, blockの大きさ)
+HEADER_STRUCT = struct.Struct("5QI")
+
+
+class Storage(object):
+    """
+    イメージファイル(またはブロックデバイス)をマウント中ずっと開いておき、mmapして読み書きする
+    readonlyならファイルは読み出し専用で開き、書き込みはメモリ上の写し(ACCESS_COPY)にだけ入る
+    """
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+        # ブロックデバイスはst_sizeが0なので末尾までseekして大きさを得る
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.is_file = S_ISREG(os.fstat(self.fd).st_mode)
+        self.map = self._mmap()
+        self.lock = threading.Lock()  # mmapの位置を動かすwriteを守る
+
+    def _mmap(self):
+        if self.readonly:
+            return mmap.mmap(self.fd, self.size, access=mmap.ACCESS_COPY)
+        return mmap.mmap(self.fd, self.size)
+
+    # レイアウトに足りない分を(sparseに)伸ばす
+    def ensure_size(self, size):
+        if size <= self.size:
+            return
+        if not self.is_file or self.readonly:
+            raise IOError("{} is too small for testfs.".format(self.path))
+        self.map.close()
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self.map = self._mmap()
+
+    # コピーせずに参照するだけの読み出し
+    def view(self, offset, size):
+        return buffer(self.map, offset, size)
+
+    def read(self, offset, size):
+        return self.map[offset:offset+size]
+
+    def write(self, offset, data):
+        # python2のmmapはbytearrayを直接書けないのでbufferで包む
+        with self.lock:
+            self.map.seek(offset)
+            self.map.write(buffer(data))
+
+    def unpack(self, st, offset):
+        return st.unpack_from(self.map, offset)
+
+    def pack(self, st, offset, *values):
+        st.pack_into(self.map, offset, *values)
+
+    def sync(self, datasync=False):
+        if self.readonly:
+            return
+        self.map.flush()
+        if datasync:
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        os.close(self.fd)
+
+
+class Bitmap(object):
+    """
+    使用状況のbitmap、bitの並びはディスク上と同じく各byteの上位bitから
+    group毎の空き数を持っておき、探索はbyte単位(正規表現)で使用済みの所を読み飛ばす
+    """
+    group_bits = 4096
+    zero_bits = "".join(chr(8 - bin(i).count("1")) for i in xrange(256))  # byte中の0の数
+    first_zero = [8 - len(bin(i ^ 0xff)) + 2 if i != 0xff else 8 for i in xrange(256)]
+    first_one = [8 - len(bin(i)) + 2 if i != 0 else 8 for i in xrange(256)]
+    not_full = re.compile(b"[^\xff]")
+    not_empty = re.compile(b"[^\x00]")
+
+    def __init__(self, data, length):
+        self.bits = bytearray(data)
+        self.length = length  # 有効なbit数
+        self.groups = (length - 1) / self.group_bits + 1
+        self.group_free = [self._count_free(g * self.group_bits,
+                                            min((g + 1) * self.group_bits, length))
+                           for g in xrange(self.groups)]
+        self.free = sum(self.group_free)
+        self.hint = 0  # 次に探し始める位置(next-fit)
+        self.dirty_groups = set()  # 前回のdeltas()から書き換わったgroup
+
+    def _count_free(self, start, end):
+        n = 0
+        while start < end and start % 8 != 0:
+            n += not self.get(start)
+            start += 1
+        while end > start and end % 8 != 0:
+            end -= 1
+            n += not self.get(end)
+        chunk = self.bits[start/8:end/8].translate(self.zero_bits)
+        return n + sum(chunk)
+
+    def get(self, address):
+        return (self.bits[address >> 3] >> (7 - (address & 7))) & 1 == 1
+
+    # [start, start+count)の使用中の数
+    def used(self, start, count):
+        return count - self._count_free(start, start + count)
+
+    # pos以降で最初の0bitの位置、無ければlength
+    def next_zero(self, pos):
+        if pos >= self.length:
+            return self.length
+        i = pos >> 3
+        b = self.bits[i] | ((0xff00 >> (pos & 7)) & 0xff)
+        if b == 0xff:
+            m = self.not_full.search(self.bits, i + 1)
+            if m is None:
+                return self.length
+            i = m.start()
+            b = self.bits[i]
+        return min(i * 8 + self.first_zero[b], self.length)
+
+    # pos以降で最初の1bitの位置、limitまでに無ければlimit(省略するとlength)
+    def next_one(self, pos, limit=None):
+        if limit is None or limit > self.length:
+            limit = self.length
+        if pos >= limit:
+            return limit
+        i = pos >> 3
+        b = self.bits[i] & (0xff >> (pos & 7))
+        if b == 0:
+            m = self.not_empty.search(self.bits, i + 1, (limit - 1) / 8 + 1)
+            if m is None:
+                return limit
+            i = m.start()
+            b = self.bits[i]
+        return min(i * 8 + self.first_one[b], limit)
+
+    # [lo, hi)の中でcount個連続した空きの先頭、無ければNone
+    def _find_run(self, count, lo, hi):
+        pos = lo
+        while pos < hi:
+            start = self.next_zero(pos)
+            if start >= hi:
+                break
+            end = self.next_one(start, start + count)
+            if end - start >= count:
+                return start
+            pos = end
+        return None
+
+    # hintから後ろを探し、無ければ先頭から探す
+    def find_run(self, count, hint=None):
+        if count > self.free:
+            return None
+        if hint is None:
+            hint = self.hint
+        start = self._find_run(count, hint, self.length)
+        if start is None and hint > 0:
+            start = self._find_run(count, 0, min(hint + count, self.length))
+        return start
+
+    # 連続した空きを(先頭, 長さ)で順に返す
+    def free_runs(self):
+        pos = self.next_zero(0)
+        while pos < self.length:
+            end = self.next_one(pos)
+            yield pos, end - pos
+            pos = self.next_zero(end)
+
+    # count個以上連続した空きのうち一番短いものの先頭、無ければNone(長い空きを残しておける)
+    def best_run(self, count):
+        best = None
+        for start, length in self.free_runs():
+            if length >= count and (best is None or length < best[1]):
+                best = (start, length)
+                if length == count:
+                    break
+        return best and best[0]
+
+    def _update_groups(self, start, count, diff):
+        end = start + count
+        while start < end:
+            g = start / self.group_bits
+            n = min((g + 1) * self.group_bits, end) - start
+            self.group_free[g] += diff * n
+            self.dirty_groups.add(g)
+            start += n
+        self.free += diff * count
+
+    def _fill(self, start, count, used):
+        end = start + count
+        pos = start
+        while pos < end and (pos & 7 != 0 or end - pos < 8):
+            if used:
+                self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+            else:
+                self.bits[pos >> 3] &= ~(0x80 >> (pos & 7)) & 0xff
+            pos += 1
+        if pos < end:
+            n = (end - pos) / 8
+            self.bits[pos/8:pos/8+n] = (b"\xff" if used else b"\x00") * n
+            self._fill(pos + n * 8, end - pos - n * 8, used)
+
+    # [start, start+count)を使用中にする、全て空いている前提
+    def set_range(self, start, count):
+        self._fill(start, count, True)
+        self._update_groups(start, count, -1)
+        self.hint = start + count
+
+    # [start, start+count)を空きにする、全て使用中の前提
+    def clear_range(self, start, count):
+        self._fill(start, count, False)
+        self._update_groups(start, count, 1)
+
+    # 書き換わったgroupの(headからのアドレス, データ)のリスト
+    def deltas(self, head):
+        group_bytes = self.group_bits / 8
+        d = []
+        for g in sorted(self.dirty_groups):
+            begin = g * group_bytes
+            d.append((head + begin, str(self.bits[begin:begin+group_bytes])))
+        self.dirty_groups.clear()
+        return d
+
+
+class TestFSHeader(object):
+    byte_size = 8
+    block_size = 512  # mktestfsで指定しなかった時のblockの大きさ
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()  # bitmapを触る操作を守る
+        self.released = []  # 解放されたがまだコミットされていない[開始index, block数]
+        self.committing = []  # コミット中のトランザクションで解放されるblock
+        (self.max_ino, self.max_blk, _, _, self.journal_blocks,
+         self.block_size) = storage.unpack(HEADER_STRUCT, 0)
+        if not self.valid_block_size(self.block_size):
+            raise IOError("{} is not a testfs image (block size {}).".format(
+                storage.path, self.block_size))
+        self.inode_bytes = (self.max_ino-1)/self.byte_size+1
+        self.blk_bytes = (self.max_blk-1)/self.byte_size+1
+        # 各データの先頭アドレス
+        (self.ino_status_head, self.blk_status_head, self.content_head, self.journal_head,
+         self.data_head, size) = self.layout(self.max_ino, self.max_blk, self.journal_blocks,
+                                             self.block_size)
+        storage.ensure_size(size)
+        # bitmapとinodeエントリを読む前に、前回落ちた時に残ったトランザクションを反映する
+        self.journal = Journal(storage, self.journal_head, self.journal_blocks * self.block_size,
+                               self.block_size)
+        self.replayed = self.journal.replay()
+        self.ino_status = Bitmap(storage.view(self.ino_status_head, self.inode_bytes),
+                                 self.max_ino)
+        self.blk_status = Bitmap(storage.view(self.blk_status_head, self.blk_bytes),
+                                 self.max_blk)
+
+    # 各領域の先頭アドレスとイメージ全体の大きさ
+    # ジャーナルと実データの領域はblockの境界に揃える
+    @classmethod
+    def layout(cls, max_ino, max_blk, journal_blocks, block_size):
+        ino_status_head = HEADER_STRUCT.size
+        blk_status_head = ino_status_head + (max_ino - 1) / cls.byte_size + 1
+        content_head = blk_status_head + (max_blk - 1) / cls.byte_size + 1
+        journal_head = content_head + CONTENT_STRUCT.size * max_ino
+        journal_head = (journal_head + block_size - 1) / block_size * block_size
+        data_head = journal_head + journal_blocks * block_size
+        return (ino_status_head, blk_status_head, content_head, journal_head, data_head,
+                data_head + max_blk * block_size)
+
+    # マウントせずに調べるツール用に、イメージには書かずに開く
+    # ジャーナルに残っている分はメモリ上の写しにだけ反映するので、マウント中や読み出し専用のイメージでもよい
+    @classmethod
+    def open_readonly(cls, path):
+        return cls(Storage(path, readonly=True))
+
+    # 全部空いている状態のイメージを作る
+    # ヘッダだけ書いて残りはftruncateでsparseに伸ばすので、大きさによらず時間もメモリもかからない
+    @classmethod
+    def create(cls, path, max_ino, max_blk, journal_blocks=0, block_size=None):
+        block_size = block_size or cls.block_size
+        if not cls.valid_block_size(block_size):
+            raise ValueError("Invalid block size {}.".format(block_size))
+        size = cls.layout(max_ino, max_blk, journal_blocks, block_size)[-1]
+        with open(path, 'wb') as f:
+            f.write(HEADER_STRUCT.pack(max_ino, max_blk, max_ino, max_blk, journal_blocks,
+                                       block_size))
+            f.truncate(size)
+
+    # blockの大きさは512から64KiBまでの2の冪
+    @staticmethod
+    def valid_block_size(size):
+        return 512 <= size <= 65536 and size & (size - 1) == 0
+
+    # ジャーナルを通さずに直接書く
+    def flush(self):
+        for address, data in self.deltas():
+            self.storage.write(address, data)
+        self.committed()
+
+    # ヘッダと書き換わったbitmapのgroupを(アドレス, データ)のリストで返す
+    # 解放されたblockはディスク上では空きにするが、committed()までは使用中のままにしておく
+    def deltas(self):
+        with self.lock:
+            hint = self.blk_status.hint
+            for start, count in self.released:
+                self.blk_status.clear_range(start, count)
+            d = [(0, HEADER_STRUCT.pack(self.max_ino, self.max_blk, self.free_inodes,
+                                        self.free_blocks, self.journal_blocks,
+                                        self.block_size))]
+            d += self.ino_status.deltas(self.ino_status_head)
+            d += self.blk_status.deltas(self.blk_status_head)
+            for start, count in self.released:
+                self.blk_status.set_range(start, count)
+            self.blk_status.hint = hint
+            self.committing, self.released = self.released, []
+        return d
+
+    # 集めたメタデータの変更をジャーナルに書いてから元の場所に書き、解放したblockを使えるようにする
+    # pagesはPageCache.pin_meta()で取ったページ、ファイルの中身は先にディスクに届けておくこと
+    # ジャーナルに入りきらずに直接書いた時はFalseを返す
+    def commit(self, deltas, pages, cache):
+        journal = self.journal
+        blocks = [(self.block_index2address(i), d) for i, d in pages]
+        logged = journal.log(deltas + blocks)
+        for address, data in deltas:
+            self.storage.write(address, data)
+        cache.write_pinned(pages)
+        if not logged:
+            # 後のトランザクションがこの変更の上に積まれるので、先にディスクに届けておく
+            self.storage.sync()
+        self.committed()
+        return logged or journal.log_size == 0
+
+    # deltas()の内容がディスクに届いたので、解放したblockを使えるようにする
+    def committed(self):
+        with self.lock:
+            for start, count in self.committing:
+                self.blk_status.clear_range(start, count)
+            self.committing = []
+
+    # 空き数はBitmapがset_range/clear_rangeの度に数え直しているのでそのまま返す
+    @property
+    def free_inodes(self):
+        return self.ino_status.free
+
+    @property
+    def free_blocks(self):
+        return self.blk_status.free
+
+    # 空き領域の断片化の具合
+    # 空きblock数、一番長い連続した空き、長さ(2の冪に切り下げ)毎の連続した空きの数と、
+    # scoreとして1 - 一番長い空き/空きblock数(空きが1つにまとまっていれば0)を返す
+    def fragmentation(self):
+        bitmap = self.blk_status
+        runs = defaultdict(int)
+        largest = 0
+        with self.lock:
+            free = bitmap.free
+            for _, n in bitmap.free_runs():
+                largest = max(largest, n)
+                runs[1 << (n.bit_length() - 1)] += 1
+        score = 1 - float(largest) / free if free else 0.0
+        return {"free": free, "largest": largest, "runs": dict(runs), "score": score}
+
+    # 空いているinode番号を得る
+    def next_ino(self):
+        with self.lock:
+            i = self.ino_status.find_run(1)
+            if i is None:
+                raise IOError("All inode entries are used.")
+            self.ino_status.set_range(i, 1)
+        return i + ROOT_INODE
+
+    def release_ino(self, inode):
+        with self.lock:
+            self.ino_status.clear_range(inode - ROOT_INODE, 1)
+
+    def release_block(self, block):
+        self.release_blocks(block, 1)
+
+    # 解放を記録したトランザクションがコミットされるまでは再利用しない
+    # (先に別のファイルのデータが書かれると、落ちた時に古いメタデータがそれを指してしまう)
+    def release_blocks(self, start, count):
+        with self.lock:
+            self.released.append((start, count))
+
+    def is_usedino(self, inode):
+        return self.ino_status.get(inode - ROOT_INODE)
+
+    # indexから実際にディスク上のアドレスを返す
+    def content_index2address(self, index):
+        return self.content_head + CONTENT_STRUCT.size * index
+
+    def block_index2address(self, index):
+        return self.data_head + index * self.block_size
+
+    # PageCacheがそのまま書き換えられるようにbytearrayで返す
+    def read_block(self, index):
+        return bytearray(self.storage.view(self.block_index2address(index), self.block_size))
+
+    def write_block(self, index, data):
+        self.storage.write(self.block_index2address(index), data)
+
+    # blks個のblockを確保して[開始index, block数]のリストを返す
+    # goalから連続して取れる分はそこから取り、残りは連続領域を優先して探す
+    def allocate(self, blks, goal=None):
+        with self.lock:
+            return self._allocate(blks, goal)
+
+    def _allocate(self, blks, goal):
+        bitmap = self.blk_status
+        if blks > bitmap.free:
+            raise IOError("No space is avilable.")
+        extents = []
+        if goal is not None and goal < self.max_blk and not bitmap.get(goal):
+            count = bitmap.next_one(goal, goal + blks) - goal
+            bitmap.set_range(goal, count)
+            extents.append([goal, count])
+            blks -= count
+        if blks == 0:
+            return extents
+        start = bitmap.find_run(blks)
+        if start is not None:
+            bitmap.set_range(start, blks)
+            extents.append([start, blks])
+            return extents
+        # 連続領域が無ければ空いているblockをhintから順に集める
+        pos = bitmap.hint
+        while blks > 0:
+            start = bitmap.next_zero(pos)
+            if start >= self.max_blk:
+                pos = 0
+                continue
+            count = bitmap.next_one(start, start + blks) - start
+            bitmap.set_range(start, count)
+            extents.append([start, count])
+            blks -= count
+            pos = start + count
+        return extents
+
+
+class InodeTable(object):
+    """
+    inodeエントリの表、マウント時に1回でまとめて読んでbytearrayで持つ
+    """
+    def __init__(self, header):
+        self.header = header
+        self.storage = header.storage
+        self.records = bytearray(self.storage.view(header.content_head,
+                                                   CONTENT_STRUCT.size * header.max_ino))
+        self.dirty = set()
+
+    def _offset(self, inode):
+        return CONTENT_STRUCT.size * (inode - ROOT_INODE)
+
+    def get(self, inode):
+        return CONTENT_STRUCT.unpack_from(self.records, self._offset(inode))
+
+    # ディスクにはdeltas()で取り出して書く
+    def put(self, inode, record):
+        CONTENT_STRUCT.pack_into(self.records, self._offset(inode), *record)
+        self.dirty.add(inode)
+
+    def deltas(self):
+        d = []
+        for inode in sorted(self.dirty):
+            off = self._offset(inode)
+            d.append((self.header.content_head + off,
+                      str(self.records[off:off+CONTENT_STRUCT.size])))
+        self.dirty.clear()
+        return d
+
+
+class Blocks(object):
+    """
+    ファイルの実データをextent([開始block index, block数])のリストで管理する
+    extentのリストはデータ領域上のextent map blockに保存する
+    データはPageCache上のblock毎のbytearrayで、writeは該当するblockをその場で書き換える
+    metaが真(ディレクトリとシンボリックリンク)ならblockはジャーナルを通して書かれる
+    """
+    map_struct = struct.Struct('2Q')  # extent map blockのヘッダ (extent数, 次のmap block)
+    extent_struct = struct.Struct('2Q')  # (開始block index, block数)
+
+    def __init__(self, header, cache, head=NULL_BLOCK, size=0, meta=False):
+        self.header = header  # TestFSHeaderのインスタンス
+        self.cache = cache  # PageCacheのインスタンス
+        self.head = head  # extent mapの先頭block index
+        self.size = size
+        self.meta = meta
+        self.block_size = self.header.block_size
+        self.extents = []  # [開始block index, block数]のリスト
+        self.map_blocks = []  # extent mapを格納しているblock
+        self.map_dirty = False
+        self._starts = []  # 各extentのファイル内での先頭block番号
+        if self.head != NULL_BLOCK:
+            self._load_map()
+        self._update_length()
+
+    def _load_map(self):
+        per_block = (self.block_size - self.map_struct.size) / self.extent_struct.size
+        index = self.head
+        while index != NULL_BLOCK:
+            d = self.cache.get(index)
+            count, next_index = self.map_struct.unpack_from(d)
+            for i in xrange(min(count, per_block)):
+                start, length = self.extent_struct.unpack_from(
+                    d, self.map_struct.size + i * self.extent_struct.size)
+                self.extents.append([start, length])
+            self.map_blocks.append(index)
+            index = next_index
+
+    def _update_length(self):
+        self._starts = []
+        n = 0
+        for _, length in self.extents:
+            self._starts.append(n)
+            n += length
+        self._blk_length = n  # 保有しているブロック数
+        self.max_size = self._blk_length * self.block_size   # 保有している最大サイズ
+
+    # ファイル内のblock番号からディスク上のblock indexを返す
+    def _block_index(self, n):
+        if not 0 <= n < self._blk_length:
+            raise IndexError(n)
+        i = bisect_right(self._starts, n) - 1
+        return self.extents[i][0] + n - self._starts[i]
+
+    # ファイル内のblock番号nからcount個を、ディスク上で連続した(block index, 数)に分けて返す
+    def runs(self, n, count):
+        end = min(n + count, self._blk_length)
+        i = bisect_right(self._starts, n) - 1
+        while n < end:
+            start, length = self.extents[i]
+            k = min(self._starts[i] + length, end) - n
+            yield start + n - self._starts[i], k
+            n += k
+            i += 1
+
+    def _grow(self, blks):
+        goal = None
+        if self.extents:
+            goal = self.extents[-1][0] + self.extents[-1][1]
+        for start, length in self.header.allocate(blks, goal):
+            if self.extents and self.extents[-1][0] + self.extents[-1][1] == start:
+                self.extents[-1][1] += length
+            else:
+                self.extents.append([start, length])
+        # 新しく確保したblockは以前のデータが残っているのでゼロで埋める
+        self.map_dirty = True
+        length = self._blk_length
+        self._update_length()
+        for n in xrange(length, self._blk_length):
+            self.cache.put(self._block_index(n), bytearray(self.block_size), self.meta)
+
+    def _shrink(self, blks):
+        keep = self._blk_length - blks
+        while self._blk_length > keep:
+            start, length = self.extents[-1]
+            n = min(length, self._blk_length - keep)
+            for i in xrange(start + length - n, start + length):
+                self.cache.discard(i)
+            self.header.release_blocks(start + length - n, n)
+            if n == length:
+                self.extents.pop()
+            else:
+                self.extents[-1][1] -= n
+            self._blk_length -= n
+        self.map_dirty = True
+        self._update_length()
+
+    def set_size(self, size):
+        blks = (size - 1) / self.block_size + 1
+        if blks > self._blk_length:
+            self._grow(blks - self._blk_length)
+        elif blks < self._blk_length:
+            self._shrink(self._blk_length - blks)
+        if size < self.size and size % self.block_size != 0:
+            # 切り詰めた末尾は後で伸ばしたときに見えないようにゼロにする
+            n = size / self.block_size
+            off = size % self.block_size
+            self.cache.write(self._block_index(n), off, bytearray(self.block_size - off),
+                             self.meta)
+        self.size = size
+
+    # 連続したblockはまとめてPageCache.readに渡し、block毎に切り分けない
+    def read(self, offset=0, size=0):
+        if size == 0 or offset + size > self.size:
+            size = self.size - offset
+        if size <= 0:
+            return ""
+        n = offset / self.block_size
+        begin = offset - n * self.block_size
+        pieces = []
+        for index, count in self.runs(n, (begin + size - 1) / self.block_size + 1):
+            length = min(count * self.block_size - begin, size)
+            pieces.append(self.cache.read(index, begin, length))
+            size -= length
+            begin = 0
+        return "".join(pieces)
+
+    def write(self, offset, buf):
+        if not buf:
+            return
+        end = offset + len(buf)
+        if end > self.size:
+            self.set_size(end)
+        buf = memoryview(buf)
+        pos = offset
+        while pos < end:
+            n = pos / self.block_size
+            begin = pos - n * self.block_size
+            length = min(self.block_size - begin, end - pos)
+            index = self._block_index(n)
+            piece = buf[pos-offset:pos-offset+length]
+            if length == self.block_size:
+                # block全体を書き換えるなら元のデータを読む必要はない
+                self.cache.put(index, bytearray(piece), self.meta)
+            else:
+                self.cache.write(index, begin, piece, self.meta)
+            pos += length
+
+    # データのblockはPageCacheが書き出すので、ここではextent mapだけ書く
+    # extent mapはメタデータとしてPageCacheに置き、ジャーナルを通して書かれる
+    def flush(self):
+        if self.map_dirty:
+            self._flush_map()
+
+    def _flush_map(self):
+        per_block = (self.block_size - self.map_struct.size) / self.extent_struct.size
+        need = (len(self.extents) - 1) / per_block + 1
+        while len(self.map_blocks) < need:
+            self.map_blocks.extend(s for s, _ in self.header.allocate(1))
+        while len(self.map_blocks) > need:
+            index = self.map_blocks.pop()
+            self.cache.discard(index)
+            self.header.release_block(index)
+        for i, index in enumerate(self.map_blocks):
+            extents = self.extents[i*per_block:(i+1)*per_block]
+            if i + 1 < len(self.map_blocks):
+                next_index = self.map_blocks[i+1]
+            else:
+                next_index = NULL_BLOCK
+            d = self.map_struct.pack(len(extents), next_index)
+            d += "".join(self.extent_struct.pack(*e) for e in extents)
+            self.cache.put(index, bytearray(d.ljust(self.block_size, "\x00")), True)
+        self.head = self.map_blocks[0] if self.map_blocks else NULL_BLOCK
+        self.map_dirty = False
+
+    # データを連続した[start, start+保有block数)に、extent mapをその直後のblockに移す
+    # 移し先は呼び出し側が確保しておく、元のblockは解放がコミットされるまで再利用されないので
+    # コミット前に落ちても前のextent mapから元のデータを読める
+    def move(self, start):
+        chunk = max(2**20 / self.block_size, 1)  # 1回に読むblock数
+        pos = start
+        for old, length in self.extents:
+            for i in xrange(0, length, chunk):
+                n = min(chunk, length - i)
+                d = self.cache.read(old + i, 0, n * self.block_size)
+                for j in xrange(n):
+                    piece = d[j*self.block_size:(j+1)*self.block_size]
+                    self.cache.put(pos + i + j, bytearray(piece), self.meta)
+                    self.cache.discard(old + i + j)
+            self.header.release_blocks(old, length)
+            pos += length
+        for index in self.map_blocks:
+            self.cache.discard(index)
+            self.header.release_block(index)
+        self.extents = [[start, pos - start]]
+        self.map_blocks = [pos]
+        self.map_dirty = True
+        self._update_length()
+
+    # indexのblockがこのファイルのものか
+    def owns(self, index):
+        for start, length in self.extents:
+            if start <= index < start + length:
+                return True
+        return index in self.map_blocks
+
+    def release(self):
+        for start, length in self.extents:
+            for i in xrange(start, start + length):
+                self.cache.discard(i)
+            self.header.release_blocks(start, length)
+        for index in self.map_blocks:
+            self.cache.discard(index)
+            self.header.release_block(index)
+        self.extents = []
+        self.map_blocks = []
+        self._update_length()
+
+
+class PageCache(object):
+    """
+    全inodeで共有するblock単位のキャッシュ
+    ディスク上のblock indexをキーにしてCLOCKで追い出し、dirtyなものは追い出す時に書き戻す
+    (OrderedDictはページ毎にGCが追うリストを作るので、大きくするとGCの時間が増えていく)
+    メタデータのページはジャーナルにコミットされて元の場所に書かれるまで追い出さない
+    """
+    default_size = 64 * 2**20  # byte
+
+    def __init__(self, header, capacity):
+        self.header = header
+        self.capacity = max(capacity, 1)  # 保持するblock数
+        self.lock = threading.RLock()
+        self.pages = {}  # block index -> データ(bytearray)
+        self.ring = []  # CLOCKの針が回るblock indexの列
+        self.slot = {}  # block index -> ringの位置
+        self.holes = []  # discardで空いたringの位置
+        self.referenced = set()
+        self.hand = 0
+        self.dirty = set()
+        self.meta = set()  # dirtyなメタデータのページ
+        self.pinned = set()  # ジャーナルに書いたが元の場所にはまだ書いていないページ
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.direct = 0  # キャッシュを通さずに読んだblock数
+
+    def get(self, index):
+        with self.lock:
+            return self._get(index)
+
+    def _get(self, index):
+        d = self.pages.get(index)
+        if d is not None:
+            self.hits += 1
+            self.referenced.add(index)
+            return d
+        self.misses += 1
+        d = self.header.read_block(index)
+        self._insert(index, d)
+        return d
+
+    def put(self, index, data, meta=False):
+        with self.lock:
+            if index in self.pages:
+                self.pages[index] = data
+                self.referenced.add(index)
+            else:
+                self._insert(index, data)
+            (self.meta if meta else self.dirty).add(index)
+
+    # indexのblockのoffsetから、続くblockにまたがってsize byteを読む
+    # キャッシュにあるページはそれを使い、無いblockはキャッシュに入れずにディスクから直接読む
+    # (大きなファイルを流し読みしてもキャッシュを押し流さず、block毎のコピーもしない)
+    def read(self, index, offset, size):
+        block_size = self.header.block_size
+        count = (offset + size - 1) / block_size + 1
+        address = self.header.block_index2address(index)
+        with self.lock:
+            cached = [i for i in xrange(index, index + count) if i in self.pages]
+            self.hits += len(cached)
+            self.direct += count - len(cached)
+            if not cached:
+                return self.header.storage.read(address + offset, size)
+            self.referenced.update(cached)
+            d = bytearray(self.header.storage.view(address, count * block_size))
+            for i in cached:
+                pos = (i - index) * block_size
+                d[pos:pos+block_size] = self.pages[i]
+        return str(d[offset:offset+size])
+
+    # ページの一部をその場で書き換える(途中で追い出されないようにロックの中で)
+    def write(self, index, offset, data, meta=False):
+        with self.lock:
+            self._get(index)[offset:offset+len(data)] = data
+            (self.meta if meta else self.dirty).add(index)
+
+    # 解放されたblockは書き戻さずに捨てる
+    def discard(self, index):
+        with self.lock:
+            if index not in self.pages:
+                return
+            del self.pages[index]
+            pos = self.slot.pop(index)
+            self.ring[pos] = None
+            self.holes.append(pos)
+            self.referenced.discard(index)
+            self.dirty.discard(index)
+            self.meta.discard(index)
+
+    # dirtyなデータのページを書き出して数を返す、メタデータのページは書かない
+    # ownerを指定するとowner.owns()が真になるblockだけを書き出す
+    def flush(self, owner=None):
+        with self.lock:
+            targets = [i for i in self.dirty if owner is None or owner.owns(i)]
+            for index in sorted(targets):
+                self.header.write_block(index, self.pages[index])
+            self.writebacks += len(targets)
+            self.dirty.difference_update(targets)
+        return len(targets)
+
+    # dirtyなメタデータのページの写しを(block index, データ)のリストで返し、
+    # write_pinned()で書かれるまで追い出さないようにする
+    def pin_meta(self):
+        with self.lock:
+            pages = [(i, str(self.pages[i])) for i in sorted(self.meta)]
+            self.pinned.update(self.meta)
+            self.meta.clear()
+        return pages
+
+    # pin_meta()で取った写しを元の場所に書く
+    # その後で解放されたblockも、解放がコミットされるまでは再利用されないので書いてよい
+    def write_pinned(self, pages):
+        with self.lock:
+            for index, data in pages:
+                self.header.write_block(index, data)
+            self.writebacks += len(pages)
+            self.pinned.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"pages": len(self.pages), "capacity": self.capacity,
+                    "dirty": len(self.dirty), "meta": len(self.meta), "hits": self.hits,
+                    "misses": self.misses, "direct": self.direct,
+                    "evictions": self.evictions, "writebacks": self.writebacks}
+
+    def _insert(self, index, data):
+        if self.holes:
+            pos = self.holes.pop()
+        elif len(self.ring) < self.capacity:
+            pos = len(self.ring)
+            self.ring.append(None)
+        else:
+            pos = self._evict()
+        self.ring[pos] = index
+        self.slot[index] = pos
+        self.pages[index] = data
+
+    # 参照ビットが立っていないページまで針を進めて追い出し、空いた位置を返す
+    def _evict(self):
+        for _ in xrange(2 * len(self.ring)):
+            pos = self.hand
+            index = self.ring[pos]
+            self.hand = (self.hand + 1) % len(self.ring)
+            if index in self.referenced:
+                self.referenced.discard(index)
+                continue
+            if index in self.meta or index in self.pinned:
+                continue
+            d = self.pages.pop(index)
+            del self.slot[index]
+            self.evictions += 1
+            if index in self.dirty:
+                self.header.write_block(index, d)
+                self.dirty.discard(index)
+                self.writebacks += 1
+            return pos
+        # 全部コミット待ちのメタデータなら容量を超えて持つ
+        self.ring.append(None)
+        return len(self.ring) - 1
+
+
+class Readahead(object):
+    """
+    連続した読み出しを見つけて、その先のblockを別スレッドでイメージファイルから読んでおく
+    ファイル毎にいくつかの流れ[次に来るはずのoffset, 窓のblock数, 読んである所]を覚えておき、
+    続きが来る度に窓を倍にして、読んである所までが窓の半分を切ったら次を頼む
+    PageCacheには入れずにOSのページキャッシュを温めるだけなので、書き換えと食い違うことはない
+    読むのはスレッド専用のfdからで、その間はGILを離すので呼び出し側の処理と重なる
+    """
+    streams = 4  # 1ファイルで同時に追う流れの数
+    min_window = 8 * 2**10  # byte
+    max_window = 2**20  # byte
+
+    def __init__(self, storage, header):
+        self.path = storage.path
+        self.header = header
+        self.min_blocks = max(self.min_window / header.block_size, 1)
+        self.max_blocks = max(self.max_window / header.block_size, 1)
+        self.lock = threading.Lock()
+        self.files = {}  # key -> 流れのリスト(最近使った順)
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.requests = 0
+        self.blocks = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="testfs-readahead")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # keyのファイル(blocksのBlocks)のoffからsize byteが読まれた
+    # blocksのextentを見るので、呼び出し側はそのファイルのロックを持っていること
+    def access(self, key, blocks, off, size):
+        if self.thread is None or size == 0:
+            return
+        end = off + size
+        with self.lock:
+            streams = self.files.setdefault(key, [])
+            for s in streams:
+                if s[0] == off:
+                    streams.remove(s)
+                    s[1] = min(s[1] * 2, self.max_blocks)
+                    break
+            else:
+                # 先頭から読み始めたらすぐ、途中からなら続きが来てから読んでおく
+                s = [off, self.min_blocks, 0 if off == 0 else None]
+            streams.insert(0, s)
+            del streams[self.streams:]
+            s[0] = end
+            if s[2] is None:
+                s[2] = 0
+                return
+            pos = (end - 1) / blocks.block_size + 1  # 次に読まれるblock
+            if s[2] - pos > s[1] / 2:
+                return
+            first = max(s[2], pos)
+            last = s[2] = pos + s[1]
+        runs = list(blocks.runs(first, last - first))
+        if runs:
+            self.queue.put(runs)
+
+    # 閉じられたファイルの流れを忘れる
+    def forget(self, key):
+        with self.lock:
+            self.files.pop(key, None)
+
+    def stats(self):
+        return {"requests": self.requests, "blocks": self.blocks}
+
+    def _run(self):
+        block_size = self.header.block_size
+        buf = memoryview(bytearray(self.max_blocks * block_size))
+        with io.FileIO(self.path, "r") as f:
+            while True:
+                runs = self.queue.get()
+                if runs is None:
+                    return
+                for index, count in runs:
+                    f.seek(self.header.block_index2address(index))
+                    f.readinto(buf[:count * block_size])
+                    self.blocks += count
+                self.requests += 1
+
+
+class Defragmenter(object):
+    """
+    ファイルを連続した空きに丸ごと移して、ファイルと空き領域の断片化を減らす
+    まとまっているファイルはそれより前に入る空きがあれば詰めるので、空きは後ろに寄っていく
+    ばらばらのファイルは入る中で一番短い空きに移し、長い空きはなるべく残す
+    ファイル単位で動かすので、マウント中でもそのファイルのロックを取って少しずつ進められる
+    """
+    def __init__(self, header):
+        self.header = header
+        self.cursor = 0  # 次に見るinodeエントリの位置
+        self.files = 0  # 動かしたファイル数
+        self.moved = 0  # 動かしたblock数
+
+    # 使われている次のinode番号、一周したらNoneを返して先頭に戻る
+    def next_inode(self):
+        with self.header.lock:
+            i = self.header.ino_status.next_one(self.cursor)
+            if i >= self.header.max_ino:
+                self.cursor = 0
+                return None
+            self.cursor = i + 1
+        return i + ROOT_INODE
+
+    # 動かした方が良ければblocksを移して、動かしたblock数を返す
+    def relocate(self, blocks):
+        n = blocks._blk_length
+        if n == 0:
+            return 0
+        header = self.header
+        bitmap = header.blk_status
+        with header.lock:
+            if len(blocks.extents) == 1:
+                start = bitmap._find_run(n + 1, 0, blocks.extents[0][0])
+            else:
+                start = bitmap.best_run(n + 1)
+            if start is None:
+                return 0
+            hint = bitmap.hint
+            bitmap.set_range(start, n + 1)
+            bitmap.hint = hint  # 普段の確保の位置は動かさない
+        blocks.move(start)
+        self.files += 1
+        self.moved += n
+        return n
+
+    def stats(self):
+        return {"files": self.files, "blocks": self.moved}
+
+
+class Directory(object):
+    """
+    ディレクトリの中身、エントリは(inode, レコード長, 名前の長さ)+名前のレコードで保存する
+    消したエントリはinodeを0にして空きスロットとして残し、後の追加で再利用する
+    レコードは動かないので、そのディスク上の位置をreaddirのoffsetとして使える
+    """
+    struct = struct.Struct("IHB")
+    align = 8
+    max_rec_len = (struct.size + 255 + align - 1) / align * align
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.children = {}  # 名前 -> inode
+        self.where = {}  # 名前 -> レコードの位置
+        self.slots = {}  # レコードの位置 -> [名前(空きならNone), レコード長]
+        self.free = defaultdict(list)  # レコード長 -> 空きスロットの位置
+
+    def load(self):
+        d = self.blocks.read(0, self.blocks.size)
+        off = 0
+        while off < len(d):
+            inode, rec_len, name_len = self.struct.unpack_from(d, off)
+            if rec_len < self.struct.size:
+                raise IOError("Broken directory entry at {}.".format(off))
+            if inode == 0:
+                self.slots[off] = [None, rec_len]
+                self.free[rec_len].append(off)
+            else:
+                name = d[off+self.struct.size:off+self.struct.size+name_len]
+                self.slots[off] = [name, rec_len]
+                self.children[name] = inode
+                self.where[name] = off
+            off += rec_len
+
+    # nameの入る一番短いレコード長
+    @classmethod
+    def rec_len(cls, name):
+        return (cls.struct.size + len(name) + cls.align - 1) / cls.align * cls.align
+
+    # 一番短い長さのレコード(ディスク上のまま)
+    @classmethod
+    def record(cls, name, inode):
+        rec_len = cls.rec_len(name)
+        return (cls.struct.pack(inode, rec_len, len(name)) + name).ljust(rec_len, "\x00")
+
+    def add(self, name, inode):
+        if name in self.where:
+            self.remove(name)
+        need = self.rec_len(name)
+        off = None
+        for rec_len in xrange(need, self.max_rec_len + 1, self.align):
+            if self.free[rec_len]:
+                off = self.free[rec_len].pop()
+                break
+        else:
+            rec_len = need
+            off = self.blocks.size
+        if off == self.blocks.size:
+            d = self.record(name, inode)
+        else:
+            d = self.struct.pack(inode, rec_len, len(name)) + name
+        self.blocks.write(off, d)
+        self.slots[off] = [name, rec_len]
+        self.children[name] = inode
+        self.where[name] = off
+
+    def remove(self, name):
+        off = self.where.pop(name)
+        del self.children[name]
+        rec_len = self.slots[off][1]
+        if off + rec_len == self.blocks.size:
+            del self.slots[off]
+            self.blocks.set_size(off)
+        else:
+            self.slots[off][0] = None
+            self.free[rec_len].append(off)
+            self.blocks.write(off, self.struct.pack(0, rec_len, 0))
+
+    # offの位置のレコードから順に(名前, inode, 次のoffset)を返す
+    def entries(self, off=0):
+        while off in self.slots:
+            name, rec_len = self.slots[off]
+            off += rec_len
+            if name is not None:
+                yield (name, self.children[name], off)
+
+
+class Journal(object):
+    """
+    メタデータの変更を(アドレス, データ)の組で追記していくログ
+    先頭のblockに次に反映すべきトランザクションの番号を置き、その後ろに順に追記する
+    トランザクションはヘッダ、(アドレス, 長さ)の列、データ、commitレコードの順に並べ、
+    番号とcommitレコードのcrc32が合うものだけを落ちた後に反映する
+    一杯になるか、Flusherがチェックポイントすると元の場所への書き込みを待ってから先頭に戻る
+    """
+    magic = 0x7466736a
+    super_struct = struct.Struct("2I")  # (magic, 先頭のトランザクションの番号)
+    txn_struct = struct.Struct("4I")  # (magic, 番号, 組の数, 組とデータの長さ)
+    delta_struct = struct.Struct("QI")  # (イメージ上のアドレス, 長さ)
+    commit_struct = struct.Struct("2I")  # (番号, crc32)
+
+    def __init__(self, storage, head, size, block_size=512):
+        self.storage = storage
+        self.head = head
+        self.log_head = head + block_size
+        self.log_size = max(size - block_size, 0)
+        self.lock = threading.Lock()
+        self.tail = 0  # 次に書く位置
+        self.seq = 1  # 次に書くトランザクションの番号
+        self.commits = 0
+        self.checkpoints = 0
+        if self.log_size > 0:
+            magic, seq = storage.unpack(self.super_struct, head)
+            if magic == self.magic:
+                self.seq = seq
+
+    # コミットされているトランザクションを順に元の場所に書き、数を返す
+    def replay(self):
+        n = 0
+        while self.log_size - self.tail >= self.txn_struct.size:
+            magic, seq, count, length = self.storage.unpack(self.txn_struct,
+                                                            self.log_head + self.tail)
+            end = self.tail + self.txn_struct.size + length
+            if magic != self.magic or seq != self.seq \
+               or end + self.commit_struct.size > self.log_size:
+                break
+            body = self.storage.read(self.log_head + self.tail, end - self.tail)
+            commit_seq, crc = self.storage.unpack(self.commit_struct, self.log_head + end)
+            if commit_seq != seq or zlib.crc32(body) & 0xffffffff != crc:
+                break
+            data = self.txn_struct.size + count * self.delta_struct.size
+            for i in xrange(count):
+                address, size = self.delta_struct.unpack_from(
+                    body, self.txn_struct.size + i * self.delta_struct.size)
+                self.storage.write(address, body[data:data+size])
+                data += size
+            self.tail = end + self.commit_struct.size
+            self.seq += 1
+            n += 1
+        if n > 0:
+            self.checkpoint()
+        return n
+
+    # トランザクションを書いてディスクに届くのを待つ、入りきらなければFalseを返す
+    # (その時は呼び出し側がジャーナルを通さずに書く)
+    # 入りきらない時もジャーナルを空にしてから返す、残しておくと落ちた後に
+    # 古いトランザクションが直接書いた新しいメタデータの上に反映されてしまう
+    def log(self, deltas):
+        desc = "".join(self.delta_struct.pack(address, len(data)) for address, data in deltas)
+        body = "".join([desc] + [str(data) for _, data in deltas])
+        body = self.txn_struct.pack(self.magic, self.seq, len(deltas), len(body)) + body
+        size = len(body) + self.commit_struct.size
+        with self.lock:
+            if size > self.log_size:
+                if self.log_size > 0:
+                    self._checkpoint()
+                    self.storage.sync()
+                return False
+            if self.tail + size > self.log_size:
+                self._checkpoint()
+            self.storage.write(self.log_head + self.tail, body)
+            self.storage.pack(self.commit_struct, self.log_head + self.tail + len(body),
+                              self.seq, zlib.crc32(body) & 0xffffffff)
+            self.storage.sync()
+            self.tail += size
+            self.seq += 1
+            self.commits += 1
+        return True
+
+    # 使っている割合
+    def usage(self):
+        if self.log_size == 0:
+            return 0.0
+        return float(self.tail) / self.log_size
+
+    # 元の場所への書き込みをディスクに届けてから、ジャーナルを空にする
+    def checkpoint(self):
+        with self.lock:
+            self._checkpoint()
+            self.storage.sync()
+
+    def _checkpoint(self):
+        self.storage.sync()
+        self.tail = 0
+        if self.log_size > 0:
+            self.storage.pack(self.super_struct, self.head, self.magic, self.seq)
+        self.checkpoints += 1
+
+    def stats(self):
+        with self.lock:
+            return {"commits": self.commits, "checkpoints": self.checkpoints,
+                    "usage": "{:.0%}".format(self.usage())}
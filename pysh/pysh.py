@@ -1,261 +1,1245 @@
 #!/usr/bin/python2
 #-*- coding: utf-8 -*-
 
+import gc
 import os
+import re
 import sys
-import subprocess
+import errno
+import getopt
+import contextlib
+import pipes
+import signal
 import argparse
 import readline
-import cStringIO
-from itertools import tee
+from collections import OrderedDict
 
 ENV = {}
 
-def system(args, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stdout):
-    pid = os.fork()
-    if pid == 0:
+try:
+    import ctypes
+    # このプロセスに読み込まれているlibcから探す(find_libraryはldconfigを起動するので遅い)
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.posix_spawn
+except (ImportError, OSError, AttributeError):
+    libc = None  # forkしてexecする
+
+# glibcの値
+POSIX_SPAWN_SETPGROUP = 0x02
+POSIX_SPAWN_SETSIGDEF = 0x04
+SPAWN_STRUCT_SIZE = 512  # posix_spawn_file_actions_tとposix_spawnattr_tより大きければよい
+SIGSET_SIZE = 128
+
+# Pythonやシェルが無視していて、execしても無視が引き継がれるので子プロセスでは戻すもの
+CHILD_DEFAULT_SIGNALS = [signal.SIGPIPE, signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU]
+
+class CommandHash(object):
+    """
+    コマンド名 -> PATHから見つけたパスと使った回数
+    PATHが変わったら全部捨て、覚えたパスが無くなっていたら探し直す
+    """
+    def __init__(self):
+        self.path = None
+        self.table = OrderedDict()  # コマンド名 -> [パス, 回数]
+
+    # 見つからなければNone
+    def find(self, name, count=True):
+        if "/" in name:
+            return name
+        path = get_var("PATH") or os.defpath
+        if path != self.path:
+            self.path = path
+            self.table.clear()
+        entry = self.table.get(name)
+        if entry is None or not os.access(entry[0], os.X_OK):
+            found = self.search(name)
+            if found is None:
+                self.table.pop(name, None)
+                return None
+            entry = self.table[name] = [found, 0]
+        if count:
+            entry[1] += 1
+        return entry[0]
+
+    def search(self, name):
+        for d in self.path.split(":"):
+            p = os.path.join(d or ".", name)
+            if os.path.isfile(p) and os.access(p, os.X_OK):
+                return p
+        return None
+
+    def clear(self):
+        self.table.clear()
+
+COMMANDS = CommandHash()
+
+# argsを起動してpidを返す、起動できなければメッセージを出してNone
+# pgroupを渡せばそのプロセスグループに入れる(0なら新しいグループを作る)
+def system(args, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stdout, env=None, pgroup=None):
+    path = COMMANDS.find(args[0])
+    if path is None:
+        print >>stderr, "pysh: {}: command not found".format(args[0])
+        return None
+    # 子プロセスの出力より先に、こちらで書いた分を出しておく
+    for f in (sys.stdout, stdout, stderr):
+        f.flush()
+    if libc is None:
+        pid = os.fork()
+        if pid == 0:
+            if pgroup is not None:
+                os.setpgid(0, pgroup)
+            exec_command(args, stdin, stdout, stderr, path, env)
+        return pid
+    try:
+        return spawn(path, args, stdin, stdout, stderr, env, pgroup)
+    except OSError as e:
+        print >>stderr, "pysh: {}: {}".format(args[0], e.strerror)
+        return None
+
+# posix_spawnで起動する
+# glibcはvforkのように親のメモリを写さずに子を作るので、forkと違ってシェルの大きさで遅くならない
+# 標準入出力のつなぎ替えはfile actionsのdup2、シグナルの無視を戻すのとプロセスグループはattrで行う
+def spawn(path, args, stdin, stdout, stderr, env=None, pgroup=None):
+    actions = ctypes.create_string_buffer(SPAWN_STRUCT_SIZE)
+    attr = ctypes.create_string_buffer(SPAWN_STRUCT_SIZE)
+    sigdef = ctypes.create_string_buffer(SIGSET_SIZE)
+    libc.posix_spawn_file_actions_init(actions)
+    libc.posix_spawnattr_init(attr)
+    try:
+        for f, fd in ((stdin, 0), (stdout, 1), (stderr, 2)):
+            if f.fileno() != fd:
+                libc.posix_spawn_file_actions_adddup2(actions, f.fileno(), fd)
+        libc.sigemptyset(sigdef)
+        for sig in CHILD_DEFAULT_SIGNALS:
+            libc.sigaddset(sigdef, sig)
+        libc.posix_spawnattr_setsigdefault(attr, sigdef)
+        flags = POSIX_SPAWN_SETSIGDEF
+        if pgroup is not None:
+            flags |= POSIX_SPAWN_SETPGROUP
+            libc.posix_spawnattr_setpgroup(attr, pgroup)
+        libc.posix_spawnattr_setflags(attr, ctypes.c_short(flags))
+        argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+        env = ["{}={}".format(k, v) for k, v in (env or os.environ).iteritems()]
+        envp = (ctypes.c_char_p * (len(env) + 1))(*(env + [None]))
+        pid = ctypes.c_int()
+        err = libc.posix_spawn(ctypes.byref(pid), path, actions, attr, argv, envp)
+        if err != 0:
+            raise OSError(err, os.strerror(err))
+        return pid.value
+    finally:
+        libc.posix_spawn_file_actions_destroy(actions)
+        libc.posix_spawnattr_destroy(attr)
+
+# 標準入出力をつなぎ替えてargsに置き換わる、子プロセスの中で呼ぶ
+def exec_command(args, stdin, stdout, stderr, path=None, env=None):
+    try:
+        for sig in CHILD_DEFAULT_SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
         os.dup2(stdin.fileno(), sys.stdin.fileno())
         os.dup2(stdout.fileno(), sys.stdout.fileno())
         os.dup2(stderr.fileno(), sys.stderr.fileno())
-        os.execvp(args[0], args)
-    else:
-        return pid
+        path = path or COMMANDS.find(args[0])
+        if path is None:
+            print >>sys.stderr, "pysh: {}: command not found".format(args[0])
+        else:
+            os.execve(path, args, env or os.environ)
+    except OSError as e:
+        print >>sys.stderr, "pysh: {}: {}".format(args[0], e.strerror)
+    finally:
+        # 失敗してもシェルの続きを子プロセスで動かさない
+        os._exit(127)
+
+# waitpidのstatusを終了コードにする、シグナルで終わったら128+シグナル番号
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class ParseError(Exception):
+    pass
+
+# 括弧の外にあるsepsのどれかで区切り、(区切られた部分, その後ろの区切り)の並びを返す
+# 最後の部分の区切りはNone
+def split_tokens(tokens, seps):
+    parts = []
+    depth = 0
+    start = 0
+    for i, t in enumerate(tokens):
+        if t == "(":
+            depth += 1
+        elif t == ")":
+            depth -= 1
+            if depth < 0:
+                raise ParseError("unexpected )")
+        elif depth == 0 and t in seps:
+            parts.append((tokens[start:i], t))
+            start = i + 1
+    if depth != 0:
+        raise ParseError("unbalanced parenthesis")
+    parts.append((tokens[start:], None))
+    return parts
+
+class Job(object):
+    """
+    1つのプロセスグループで動くプロセスの組
+    終了コードはプロセス毎に集め、最後のプロセスのものをジョブの終了コードにする
+    バックグラウンドで動かしたものと止まったものはJOBSの表に入り、fgとbgで動かし直せる
+    """
+    def __init__(self, exp):
+        self.exp = exp
+        self.pids = []
+        self.pgid = 0
+        self.codes = {}  # 終わったプロセス -> 終了コード
+        self.stopped = False
+        self.id = None  # 表に入っていればジョブ番号
+
+    @property
+    def command(self):
+        return format_exp(self.exp)
+
+    # 最初のプロセスがプロセスグループのリーダーになる
+    def add_pid(self, pid):
+        self.pgid = self.pgid or pid
+        self.pids.append(pid)
+        JOBS.pids[pid] = self
+        # 入れる前に終わっていれば、SIGCHLDのハンドラがジョブのものでないとして回収している
+        if pid in JOBS.reaped:
+            self.update(pid, JOBS.reaped.pop(pid))
+
+    def done(self):
+        return len(self.codes) == len(self.pids)
+
+    def exit_status(self):
+        return self.codes.get(self.pids[-1], 0)
+
+    # waitpidの結果を反映する
+    def update(self, pid, status):
+        if os.WIFSTOPPED(status):
+            self.stopped = True
+        elif os.WIFCONTINUED(status):
+            self.stopped = False
+        else:
+            self.codes[pid] = exit_code(status)
+            JOBS.pids.pop(pid, None)
+
+    # 全部終わるか、どれかが止まるまで待つ
+    def wait(self):
+        while not self.done() and not self.stopped:
+            try:
+                pid, status = os.waitpid(-self.pgid, os.WUNTRACED)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:  # 残りはSIGCHLDのハンドラが回収した
+                    break
+                raise
+            self.update(pid, status)
+
+    # 端末を持っていればジョブに渡して(端末から読むプロセスが止められないように)待ち、終わったら取り戻す
+    # 止まったら表に入れる
+    def foreground(self):
+        tty = None
+        if os.isatty(sys.stdin.fileno()) and os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp():
+            tty = sys.stdin.fileno()
+        self.stopped = False
+        # 回収しなければ終わったプロセスもグループに残っているので、端末を渡せる
+        with JOBS.holding():
+            if tty is not None:
+                os.tcsetpgrp(tty, self.pgid)
+            try:
+                # 端末を渡す前に読もうとしてSIGTTINで止まったものや、止めてあったジョブを動かす
+                os.killpg(self.pgid, signal.SIGCONT)
+            except OSError:
+                pass
+        try:
+            self.wait()
+        finally:
+            if tty is not None:
+                # 前面でないプロセスグループから端末を取り戻すとSIGTTOUが来るので無視する
+                handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+                os.tcsetpgrp(tty, os.getpgrp())
+                signal.signal(signal.SIGTTOU, handler)
+        if self.stopped:
+            JOBS.add(self)
+            print >>sys.stderr, JOBS.format(self)
+            return 128 + signal.SIGTSTP
+        JOBS.remove(self)
+        return self.exit_status()
+
+class JobTable(object):
+    """
+    ジョブの表とSIGCHLDでの子プロセスの回収
+    SIGCHLDが来たら終わった子プロセスをまとめて回収し、ジョブのものはそのジョブに反映する
+    ジョブに入っていないもの(前面で動かしたコマンド)のstatusはwait_pidのためにreapedに残す
+    """
+    def __init__(self):
+        self.jobs = OrderedDict()  # ジョブ番号 -> Job
+        self.pids = {}  # 終わっていないプロセス -> Job
+        self.reaped = {}  # ジョブに入っていないプロセス -> waitpidのstatus
+        self.interactive = False
+
+    def add(self, job):
+        if job.id is None:
+            job.id = max(self.jobs) + 1 if self.jobs else 1
+            self.jobs[job.id] = job
+        return job
+
+    def remove(self, job):
+        if job.id is not None:
+            self.jobs.pop(job.id, None)
+            job.id = None
+
+    # この間はSIGCHLDで回収しない、回収されなかった分は最後にまとめて回収する
+    @contextlib.contextmanager
+    def holding(self):
+        handler = signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        try:
+            yield
+        finally:
+            if handler == self.reap:
+                install_sigchld()
+                self.reap()
+
+    # SIGCHLDのハンドラ
+    def reap(self, signum=None, frame=None):
+        while self.wait_one(os.WNOHANG):
+            pass
+
+    # 子プロセスの状態が1つ変わるまで待って振り分ける、変わったものが無ければFalse
+    def wait_one(self, options=0):
+        try:
+            pid, status = os.waitpid(-1, options | os.WUNTRACED | os.WCONTINUED)
+        except OSError as e:
+            return e.errno == errno.EINTR
+        if pid == 0:
+            return False
+        job = self.pids.get(pid)
+        if job is not None:
+            job.update(pid, status)
+        elif not os.WIFSTOPPED(status) and not os.WIFCONTINUED(status):
+            self.reaped[pid] = status
+        return True
+
+    # %n, %%, %+, %-とpid、省略したら今のジョブ(一番新しいもの)
+    def get(self, spec=None):
+        ids = list(self.jobs)
+        if spec in (None, "%", "%%", "%+"):
+            return self.jobs[ids[-1]] if ids else None
+        if spec == "%-":
+            return self.jobs[ids[-2]] if len(ids) > 1 else None
+        try:
+            if spec.startswith("%"):
+                return self.jobs.get(int(spec[1:]))
+            pid = int(spec)
+        except ValueError:
+            return None
+        for job in self.jobs.itervalues():
+            if pid in job.pids:
+                return job
+        return self.pids.get(pid)
+
+    def format(self, job):
+        ids = list(self.jobs)
+        mark = "+" if ids and job.id == ids[-1] else "-" if len(ids) > 1 and job.id == ids[-2] else " "
+        if job.stopped:
+            state = "Stopped"
+        elif not job.done():
+            state = "Running"
+        elif job.exit_status() == 0:
+            state = "Done"
+        else:
+            state = "Exit {}".format(job.exit_status())
+        return "[{}]{}  {:<24}{}".format(job.id, mark, state, job.command)
+
+    # 終わったジョブを知らせて表から外す
+    def notify(self, out):
+        for job in self.jobs.values():
+            if job.done():
+                print >>out, self.format(job)
+                self.remove(job)
+
+    # 対話的でない時はnotifyする所が無いので、前面のコマンドの度に終わったジョブを外す
+    # 一番新しいもの($!)はwaitで終了コードを取れるように残しておく
+    def prune(self):
+        for job in self.jobs.values()[:-1]:
+            if job.done():
+                self.remove(job)
+
+JOBS = JobTable()
+
+def install_sigchld():
+    signal.signal(signal.SIGCHLD, JOBS.reap)
+    # ハンドラが動いても読み込みやwaitpidを途中で止めない
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+# forkした子プロセスは親のジョブを扱わず、端末からのシグナルで止まるようにする
+def reset_child():
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for sig in CHILD_DEFAULT_SIGNALS[1:]:
+        signal.signal(sig, signal.SIG_DFL)
+    JOBS.__init__()
+
+class Pipeline(Job):
+    """
+    |でつないだコマンドをまとめて動かす
+    全ての段を先に起動して同じプロセスグループに入れ、段毎の終了コードを集める
+    段の間のパイプは各段の子プロセスで使う端だけを残して閉じる(閉じないと読む側にEOFが来ない)
+    """
+    def __init__(self, exp):
+        super(Pipeline, self).__init__(exp)
+        self.stages = zip(exp["stages"], exp["stderr"])  # (段のAST, 標準エラー出力もパイプに流すか)
+
+    # 全ての段がプロセスグループに入るまでは、先に終わった段を回収しない
+    # (リーダーを回収するとグループが無くなり、後の段が入れなくなる)
+    def start(self, stdin, stdout, stderr):
+        with JOBS.holding():
+            self.start_stages(stdin, stdout, stderr)
+
+    def start_stages(self, stdin, stdout, stderr):
+        sys.stdout.flush()  # 書きかけの分を子プロセスにも持たせると2回出る
+        pipes = [os.pipe() for _ in self.stages[1:]]
+        for i, (stage, pipe_stderr) in enumerate(self.stages):
+            r = pipes[i-1][0] if i > 0 else stdin.fileno()
+            w = pipes[i][1] if i < len(pipes) else stdout.fileno()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    reset_child()
+                    os.setpgid(0, self.pgid)
+                    os.dup2(r, sys.stdin.fileno())
+                    os.dup2(w, sys.stdout.fileno())
+                    os.dup2(w if pipe_stderr else stderr.fileno(), sys.stderr.fileno())
+                    for fds in pipes:
+                        for fd in fds:
+                            os.close(fd)
+                    status = eval_exp(stage, exec_last=True)
+                    sys.stdout.flush()
+                finally:
+                    os._exit(status)
+            # 子と親の両方で設定しておけば、どちらが先に動いてもグループが決まっている
+            try:
+                os.setpgid(pid, self.pgid or pid)
+            except OSError:
+                pass
+            self.add_pid(pid)
+        for fds in pipes:
+            for fd in fds:
+                os.close(fd)
+
+    def run(self, stdin, stdout, stderr):
+        self.start(stdin, stdout, stderr)
+        status = self.foreground()
+        if self.done():
+            ENV["PIPESTATUS"] = " ".join(str(self.codes[pid]) for pid in self.pids)
+        return status
 
 class Parser(object):
-    st_normal = 0
-    st_squote = 1
-    st_dquote = 2
-    st_escape = 3
-    st_variable = 4
-    alnum_char = \
-      [chr(c) for c in xrange(ord("a"), ord("z")+1)] + \
-      [chr(c) for c in xrange(ord("A"), ord("Z")+1)] + \
-      [chr(c) for c in xrange(ord("0"), ord("9")+1)] + ["_"]
-    brank_string = ["\t", " ", "\n"]
-    quote_string = ["'", '"']
-    comment_string = ["#"]
-    escape_string = ["\\"]
-    variable_string = ["$"]
-    token_string = [";", "(", ")"]
-    token_part_string = [">", "<", "|", "&"]  # 後ろに続く文字に依存するもの
-    token_full_string = [">>", "<<", "||", "&&", ">&", "<&", "|&"]
+    """
+    文字列をトークンの列にする
+    トークンは演算子(";", "|"など)の文字列か、単語を表す部分のタプル
+    単語の部分は("s", 文字列)か("v", 変数名)で、クォートとエスケープはここで外す
+    1文字ずつではなく、token_reで単語の部分か演算子を1つずつ切り出す
+    #は単語の頭にあればコメント、途中にあれば普通の文字
+    改行は;と同じ区切りになる(&&や|の後ろでは続きの行とみなす)
+    """
+    token_re = re.compile(r"""
+          (?P<blank>[ \t]+)
+        | (?P<newline>\n)
+        | (?P<op>>>|<<|\|\||&&|>&|<&|\|&|[;()<>|&])
+        | '(?P<squote>[^']*)'
+        | "(?P<dquote>(?:[^"\\]|\\.)*)"
+        | \\(?P<escape>.)
+        | \$(?P<var>[A-Za-z0-9_]+|[?!\#$])
+        | (?<![^ \t\n;()<>|&])\#[^\n]*
+        | (?P<text>[^ \t\n'"\\$;()<>|&]+|\$)
+        | (?P<open>['"\\])
+    """, re.X | re.S)
+    # ダブルクォートの中では変数を展開し、\の後ろは\ " $だけを特別扱いする
+    dquote_re = re.compile(r"""
+          \\(?P<escape>[\\"$])
+        | \$(?P<var>[A-Za-z0-9_]+|[?!\#$])
+        | (?P<text>[^\\$]+|[\\$])
+    """, re.X)
+    # この後ろの改行は区切りにしない
+    continued = frozenset([";", "&", "&&", "||", "|", "|&", "("])
+
     def __init__(self):
-        self.state = self.st_normal
-        self.stream = cStringIO.StringIO()
+        self.pending = []
         self.tokens = []
-        self.buffer = ''
 
     def feed(self, s):
-        self.stream = cStringIO.StringIO(self.stream.read()+s)
+        self.pending.append(s)
 
     def parse(self):
-        while True:
-            n = self.stream.read(1)
-            if n == "":  # EOF
-                break
-            if self.state is self.st_normal:
-                if n in self.brank_string:
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                elif n == "'":
-                    self.state = self.st_squote
-                elif n == '"':
-                    self.state = self.st_dquote
-                elif n in self.comment_string:
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                    self.stream.readline()
-                elif n in self.escape_string:
-                    self.state = self.st_escape
-                elif n in self.variable_string:
-                    self.state = self.st_variable
-                    self.tokens.append(self.buffer)
-                    self.buffer = n
-                elif n in self.token_string:
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                    self.tokens.append(n)
-                elif n in self.token_part_string:
-                    self.tokens.append(self.buffer)
-                    self.buffer = n
-                    n = self.stream.read(1)
-                    if self.buffer + n in self.token_full_string:
-                        self.tokens.append(self.buffer + n)
-                        self.buffer = ''
-                    else:
-                        self.tokens.append(self.buffer)
-                        if n != '':
-                            self.stream.seek(-1, os.SEEK_CUR)
-                        self.buffer = ''
-                else:
-                    self.buffer += n
-            elif self.state is self.st_squote:  # single quote
-                if n == "'":
-                    self.state = self.st_normal
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                else:
-                    self.buffer += n
-            elif self.state is self.st_dquote:  # double quote
-                if n == '"':
-                    self.state = self.st_normal
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                else:
-                    self.buffer += n
-            elif self.state is self.st_escape:  # escape char
-                self.buffer += n
-                self.state = self.st_normal
-            elif self.state is self.st_variable:  # variable($hoge)
-                if n in self.alnum_char:
-                    self.buffer += n
-                else:
-                    self.tokens.append(self.buffer)
-                    self.buffer = ''
-                    self.state = self.st_normal
-                    if n != '':
-                        self.stream.seek(-1, os.SEEK_CUR)
-        if self.state == self.st_variable:
-            self.state = self.st_normal
-        if self.state == self.st_normal:
-            self.tokens.append(self.buffer)
-            self.buffer = ''
-            self.tokens = [t for t in self.tokens if bool(t)]
-            return True
-        else:
-            print "Encountered EOF during parsing.[state={}]".format(self.state)
+        tokens = self.tokenize("".join(self.pending))
+        if tokens is None:
+            print "Encountered EOF during parsing."
             return False
+        self.pending = []
+        self.tokens.extend(tokens)
+        return True
 
     def pop_tokens(self):
         t = self.tokens
         self.tokens = []
         return t
 
+    # クォートかエスケープが閉じていなければNone
+    def tokenize(self, s):
+        tokens = []
+        word = None
+        for m in self.token_re.finditer(s):
+            kind = m.lastgroup
+            if kind is None:  # コメント
+                continue
+            if kind == "open":
+                return None
+            if kind == "blank" or kind == "newline" or kind == "op":
+                if word is not None:
+                    tokens.append(tuple(word))
+                    word = None
+                if kind == "op":
+                    tokens.append(m.group("op"))
+                elif kind == "newline" and tokens and tokens[-1] not in self.continued:
+                    tokens.append(";")
+                continue
+            if word is None:
+                word = []
+            if kind == "squote":
+                self.add_part(word, "s", m.group("squote"))
+            elif kind == "dquote":
+                self.add_part(word, "s", "")  # ""だけでも空の単語になる
+                for d in self.dquote_re.finditer(m.group("dquote")):
+                    if d.lastgroup == "var":
+                        self.add_part(word, "v", d.group("var"))
+                    else:
+                        self.add_part(word, "s", d.group(d.lastgroup))
+            elif kind == "escape":
+                if m.group("escape") != "\n":  # 行末の\は行をつなぐだけ
+                    self.add_part(word, "s", m.group("escape"))
+            elif kind == "var":
+                self.add_part(word, "v", m.group("var"))
+            else:
+                self.add_part(word, "s", m.group(kind))
+        if word is not None:
+            tokens.append(tuple(word))
+        return tokens
+
+    # 文字列が続いたら1つにまとめる
+    @staticmethod
+    def add_part(word, kind, value):
+        if kind == "s" and word and word[-1][0] == "s":
+            word[-1] = ("s", word[-1][1] + value)
+        else:
+            word.append((kind, value))
+
+# 単語を表すトークンか
+def is_word(t):
+    return isinstance(t, tuple)
+
+# トークンの列からASTを作る
+# 優先順位は低い方から ; & -> && || -> | |& -> コマンド(と括弧)
 def build_exp(tokens):
-    sep = [";", "&", "|", "&&", "||"]
-    redirect = ["<", ">", "<<", ">>", "&>"]
+    items = []
+    for part, sep in split_tokens(tokens, [";", "&"]):
+        if part:
+            items.append((build_and_or(part), sep == "&"))
+        elif sep == "&":
+            raise ParseError("unexpected &")
+    if len(items) == 1 and not items[0][1]:
+        return items[0][0]
     exp = {}
-    exp["type"] = "exp"
-    exp["neg"] = False
-    exp["arg"] = []
-    exp["extention"] = []
-    token_iter = tokens.__iter__()
+    exp["type"] = "list"
+    exp["items"] = items  # (AST, バックグラウンドで動かすか)
+    return exp
 
-    # contains line-separater
-    for i, t in enumerate(tokens):
-        if t in sep:
-            exp["sep"] = t
-            exp["left"] = build_exp(tokens[:i])
-            if tokens[i+1:] != []:
-                exp["right"] = build_exp(tokens[i+1:])
-            else:
-                exp["right"] = None
-            return exp
+# &&と||は同じ優先順位で左から結合する
+def build_and_or(tokens):
+    parts = split_tokens(tokens, ["&&", "||"])
+    part, sep = parts[0]
+    left = build_pipeline(part)
+    for part, next_sep in parts[1:]:
+        exp = {}
+        exp["type"] = "exp"
+        exp["sep"] = sep
+        exp["left"] = left
+        exp["right"] = build_pipeline(part)
+        left = exp
+        sep = next_sep
+    return left
+
+def build_pipeline(tokens):
+    neg = False
+    if tokens and tokens[0] == (("s", "!"),):
+        neg = True
+        tokens = tokens[1:]
+    parts = split_tokens(tokens, ["|", "|&"])
+    stages = [build_command(part) for part, sep in parts]
+    if len(stages) == 1:
+        stages[0]["neg"] = neg
+        return stages[0]
+    exp = {}
+    exp["type"] = "pipeline"
+    exp["neg"] = neg
+    exp["stages"] = stages
+    exp["stderr"] = [sep == "|&" for part, sep in parts]  # 後ろの|が|&なら標準エラー出力も流す
+    return exp
+
+assign_re = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)=")
 
-    # one line
+def build_command(tokens):
+    redirect = ["<", ">", "<<", ">>", ">&", "<&"]
+    if not tokens:
+        raise ParseError("missing command")
+    exp = {}
+    exp["neg"] = False
+    exp["extention"] = []
+    if tokens[0] == "(":
+        depth = 0
+        for i, t in enumerate(tokens):
+            if t == "(":
+                depth += 1
+            elif t == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+        exp["type"] = "group"
+        exp["body"] = build_exp(tokens[1:i])
+        rest = tokens[i+1:]
+    else:
+        exp["type"] = "exp"
+        exp["arg"] = []
+        exp["assign"] = []  # 頭にあるNAME=valueの(名前, 値の単語)
+        rest = tokens
+    token_iter = iter(rest)
     for t in token_iter:
-        if t == "!":
-            exp["neg"] = True
-        elif t in redirect:
+        if t in redirect:
             red = {}
             red["type"] = "redirect"
             red["op"] = t
-            red["arg"] = token_iter.next()
+            arg = next(token_iter, None)
+            if not is_word(arg):
+                raise ParseError("missing file name after {}".format(t))
+            red["arg"] = build_word(arg)
             exp["extention"].append(red)
-        elif t[0] == "$" and len(t) != 1:  # variable
-            v = {}
-            v["type"] = "variable"
-            v["name"] = t[1:]
-            exp["arg"].append(v)
+        elif is_word(t) and exp["type"] == "exp":
+            m = assign_re.match(t[0][1]) if t[0][0] == "s" else None
+            if m and not exp["arg"]:
+                value = (("s", t[0][1][m.end():]),) + t[1:]
+                exp["assign"].append((m.group(1), build_word(value)))
+            else:
+                exp["arg"].append(build_word(t))
         else:
-            s = {}
-            s["type"] = "string"
-            s["value"] = t
-            exp["arg"].append(s)
+            raise ParseError("unexpected {}".format(t if not is_word(t) else "word after )"))
     return exp
 
-# eval order: () -> && -> || -> | -> ;
-def eval_tokens(tokens, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
-    cmdline = []
-    exit_status = 0
-    token_iter = tokens.__iter__()
-    for t in token_iter:
-        if t == "(":
-            in_paren = []
-            c = 1
-            while c > 0:
-                try:
-                    l = token_iter.next()
-                except StopIteration:
-                    print "Unbalanced parenthesis"
-                    return 1
-                in_paren.append(l)
-                if l == "(":
-                    c += 1
-                elif l == ")":
-                    c -= 1
-            eval_tokens(in_paren[:-1], stdin, stdout, stderr)
-
-
-        elif t == "&&":
-            pid = system(cmdline, stdin, stdout, stderr)
-            exit_status = os.waitpid(pid, 0)[1] >> 8
-            cmdline = []
-            if exit_status == 0:
-                exit_status = eval_tokens(list(token_iter))
-            break
-        elif t == "||":
-            pid = system(cmdline, stdin, stdout, stderr)
-            exit_status = os.waitpid(pid, 0)[1] >> 8
-            cmdline = []
-            if exit_status != 0:
-                exit_status = eval_tokens(list(token_iter))
-            break
-        elif t == "|":
-            r, w = os.pipe()
-            r = os.fdopen(r, 'r')
-            w = os.fdopen(w, 'w')
-            p1 = system(cmdline, stdin, w, stderr)
-            os.waitpid(p1, 0)
-            w.close()
-            eval_tokens(list(token_iter), stdin=r)
-            cmdline = []
-            break
-        elif t == ";":
-            pid = system(cmdline, stdin, stdout, stderr)
-            os.waitpid(pid, 0)
-            exit_status = eval_tokens(list(token_iter))
-            cmdline = []
-            break
-        elif t == ">":
-            path = token_iter.next()
-            stdout = open(path, 'w')
-        elif t == ">>":
-            path = token_iter.next()
-            stdout = open(path, 'a')
-        elif t == "<":
-            path = token_iter.next()
-            stdin = open(path, 'r')
-        elif t == "<<":
-            # TODO: raw input
-            pass
-        elif t == "&":
-            pid = system(cmdline, stdin, stdout, stderr)
-            exit_status = eval_tokens(list(token_iter))
-            cmdline = []
-            break
-        elif t[0] == "$" and len(t) != 1:  # variable
-            name = t[1:]
-            cmdline.append(ENV[name])
-        elif t == "!":
-            pass
+def build_word(word):
+    nodes = []
+    for kind, value in word:
+        n = {}
+        if kind == "s":
+            n["type"] = "string"
+            n["value"] = value
         else:
-            cmdline.append(t)
-    if cmdline:
-        pid = system(cmdline, stdin, stdout, stderr)
-        exit_status = os.waitpid(pid, 0)[1] >> 8
+            n["type"] = "variable"
+            n["name"] = value
+        nodes.append(n)
+    if len(nodes) == 1:
+        return nodes[0]
+    return {"type": "concat", "parts": nodes}
+
+# 構文の木が変わらない限り作り直さないよう、スクリプトの中身 -> ASTで覚えておく
+AST_CACHE = OrderedDict()
+AST_CACHE_SIZE = 256
+
+def compile_string(s):
+    exp = AST_CACHE.pop(s, None)
+    if exp is None:
+        tokens = Parser().tokenize(s)
+        if tokens is None:
+            raise ParseError("unexpected EOF")
+        # 大きなスクリプトだと作ったノードの数でGCが何度も走るので、作り終わるまで止める
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            exp = build_exp(tokens)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    AST_CACHE[s] = exp
+    if len(AST_CACHE) > AST_CACHE_SIZE:
+        AST_CACHE.popitem(last=False)
+    return exp
+
+def get_var(name):
+    if name in ENV:
+        return ENV[name]
+    return os.environ.get(name, "")
+
+# exportされている変数なら環境変数も変える
+def set_var(name, value):
+    ENV[name] = value
+    if name in os.environ:
+        os.environ[name] = value
+
+def expand(word):
+    if word["type"] == "string":
+        return word["value"]
+    if word["type"] == "variable":
+        return get_var(word["name"])
+    return "".join(expand(p) for p in word["parts"])
+
+# SIGCHLDのハンドラが先に回収していればその結果を使う
+def wait_pid(pid):
+    while True:
+        if pid in JOBS.reaped:
+            return exit_code(JOBS.reaped.pop(pid))
+        try:
+            return exit_code(os.waitpid(pid, 0)[1])
+        except OSError as e:
+            if e.errno == errno.ECHILD and pid in JOBS.reaped:
+                continue
+            if e.errno != errno.EINTR:
+                raise
+
+# ASTをたどって実行し、終了コードを返す
+# exec_lastが真なら最後のコマンドはforkせずにこのプロセスが置き換わる(パイプラインの段の子プロセス)
+def eval_exp(exp, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr, exec_last=False):
+    if exp["type"] == "list":
+        exit_status = 0
+        for i, (item, background) in enumerate(exp["items"]):
+            if background:
+                start_background(item, stdin, stdout, stderr)
+                exit_status = 0
+                ENV["?"] = "0"
+            else:
+                last = exec_last and i == len(exp["items"]) - 1
+                exit_status = eval_exp(item, stdin, stdout, stderr, last)
+        return exit_status
+    if exp["type"] == "pipeline":
+        exit_status = Pipeline(exp).run(stdin, stdout, stderr)
+    elif exp["type"] == "exp" and "sep" in exp:  # && ||
+        exit_status = eval_exp(exp["left"], stdin, stdout, stderr)
+        if (exp["sep"] == "&&") == (exit_status == 0):
+            exit_status = eval_exp(exp["right"], stdin, stdout, stderr, exec_last)
+        return exit_status
+    else:
+        exit_status = eval_command(exp, stdin, stdout, stderr, exec_last and not exp["neg"])
+    if exp["neg"]:
+        exit_status = int(exit_status == 0)
+    ENV["?"] = str(exit_status)
+    if not JOBS.interactive:
+        JOBS.prune()
     return exit_status
 
+# コマンドか括弧、リダイレクトで開いたファイルは終わったら閉じる
+def eval_command(exp, stdin, stdout, stderr, exec_last):
+    opened = []
+    try:
+        for red in exp["extention"]:
+            op = red["op"]
+            path = expand(red["arg"])
+            try:
+                if op == "<":
+                    f = stdin = open(path, 'r')
+                elif op == ">":
+                    f = stdout = open(path, 'w')
+                elif op == ">>":
+                    f = stdout = open(path, 'a')
+                elif op == ">&":
+                    f = stdout = stderr = open(path, 'w')
+                else:  # << <& はまだ無い
+                    print >>sys.stderr, "pysh: {} is not supported".format(op)
+                    return 2
+            except IOError as e:
+                print >>sys.stderr, "pysh: {}: {}".format(path, e.strerror)
+                return 1
+            opened.append(f)
+        if exp["type"] == "group":
+            return eval_exp(exp["body"], stdin, stdout, stderr)
+        if not exp["arg"]:
+            for name, value in exp["assign"]:
+                set_var(name, expand(value))  # 前の代入が後ろの値に効く
+            return 0
+        assign = [(name, expand(value)) for name, value in exp["assign"]]
+        args = [expand(a) for a in exp["arg"]]
+        if args[0] in BUILTINS:
+            return run_builtin(args, assign, stdin, stdout, stderr)
+        env = None
+        if assign:  # そのコマンドにだけ渡す環境変数
+            env = dict(os.environ)
+            env.update(assign)
+        if exec_last:
+            exec_command(args, stdin, stdout, stderr, env=env)
+        if JOBS.interactive:
+            # Ctrl-Zで止められるように、自分のプロセスグループで動かして端末を渡す
+            pid = system(args, stdin, stdout, stderr, env, pgroup=0)
+            if pid is None:
+                return 127
+            job = Job(exp)
+            job.add_pid(pid)
+            return job.foreground()
+        pid = system(args, stdin, stdout, stderr, env)
+        if pid is None:
+            return 127
+        return wait_pid(pid)
+    finally:
+        for f in opened:
+            f.close()
+
+# シェルの中で動かすコマンド、(引数, 標準入力, 標準出力, 標準エラー出力)を受けて終了コードを返す
+# リダイレクトは開いたファイルオブジェクトとして渡され、パイプラインの段の中ではその子プロセスで動く
+# 頭にNAME=valueがあれば、その間だけ変数を置き換える
+def run_builtin(args, assign, stdin, stdout, stderr):
+    saved = [(name, ENV.get(name), os.environ.get(name)) for name, value in assign]
+    for name, value in assign:
+        set_var(name, value)
+    try:
+        return BUILTINS[args[0]](args, stdin, stdout, stderr)
+    except (IOError, OSError) as e:
+        print >>stderr, "pysh: {}: {}".format(args[0], e.strerror)
+        return 1
+    finally:
+        for name, value, environ in reversed(saved):
+            if value is None:
+                ENV.pop(name, None)
+            else:
+                ENV[name] = value
+            if environ is not None:
+                os.environ[name] = environ
+
+def builtin_true(args, stdin, stdout, stderr):
+    return 0
+
+def builtin_false(args, stdin, stdout, stderr):
+    return 1
+
+echo_escape_re = re.compile(r"\\([\\abfnrtv])")
+echo_escapes = {"\\": "\\", "a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r",
+                "t": "\t", "v": "\v"}
+
+def builtin_echo(args, stdin, stdout, stderr):
+    args = args[1:]
+    newline = True
+    escape = False
+    while args and args[0] in ("-n", "-e", "-E"):
+        if args[0] == "-n":
+            newline = False
+        else:
+            escape = args[0] == "-e"
+        args = args[1:]
+    s = " ".join(args)
+    if escape:
+        s = echo_escape_re.sub(lambda m: echo_escapes[m.group(1)], s)
+    stdout.write(s + "\n" if newline else s)
+    return 0
+
+def builtin_cd(args, stdin, stdout, stderr):
+    if len(args) > 2:
+        print >>stderr, "pysh: cd: too many arguments"
+        return 1
+    path = args[1] if len(args) == 2 else get_var("HOME")
+    if path == "-":
+        path = get_var("OLDPWD")
+        print >>stdout, path
+    old = os.getcwd()
+    try:
+        os.chdir(path)
+    except OSError as e:
+        print >>stderr, "pysh: cd: {}: {}".format(path, e.strerror)
+        return 1
+    set_var("OLDPWD", old)
+    set_var("PWD", os.getcwd())
+    return 0
+
+def builtin_export(args, stdin, stdout, stderr):
+    if len(args) == 1:
+        for name in sorted(os.environ):
+            print >>stdout, 'export {}="{}"'.format(name, os.environ[name])
+        return 0
+    status = 0
+    for a in args[1:]:
+        name, eq, value = a.partition("=")
+        if not re.match(r"[A-Za-z_][A-Za-z0-9_]*$", name):
+            print >>stderr, "pysh: export: {}: not a valid identifier".format(a)
+            status = 1
+            continue
+        if not eq:
+            value = get_var(name)
+        ENV[name] = value
+        os.environ[name] = value
+    return status
+
+class TestError(Exception):
+    pass
+
+class Test(object):
+    """
+    testの式を評価する
+    優先順位は低い方から -o -> -a -> ! -> 単項と二項の演算子、括弧
+    """
+    unary = {
+        "-e": os.path.exists,
+        "-f": os.path.isfile,
+        "-d": os.path.isdir,
+        "-L": os.path.islink,
+        "-h": os.path.islink,
+        "-r": lambda p: os.access(p, os.R_OK),
+        "-w": lambda p: os.access(p, os.W_OK),
+        "-x": lambda p: os.access(p, os.X_OK),
+        "-s": lambda p: os.path.exists(p) and os.path.getsize(p) > 0,
+        "-n": lambda s: s != "",
+        "-z": lambda s: s == "",
+    }
+    binary = {
+        "=": lambda a, b: a == b,
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+    }
+    integer = {
+        "-eq": lambda a, b: a == b,
+        "-ne": lambda a, b: a != b,
+        "-lt": lambda a, b: a < b,
+        "-le": lambda a, b: a <= b,
+        "-gt": lambda a, b: a > b,
+        "-ge": lambda a, b: a >= b,
+    }
+
+    def __init__(self, args):
+        self.args = args
+        self.pos = 0
+
+    def evaluate(self):
+        if not self.args:
+            return False
+        result = self.expr_or()
+        if self.pos != len(self.args):
+            raise TestError("{}: unexpected argument".format(self.args[self.pos]))
+        return result
+
+    def peek(self, n=0):
+        if self.pos + n < len(self.args):
+            return self.args[self.pos + n]
+        return None
+
+    def take(self):
+        if self.pos >= len(self.args):
+            raise TestError("argument expected")
+        self.pos += 1
+        return self.args[self.pos - 1]
+
+    def expr_or(self):
+        result = self.expr_and()
+        while self.peek() == "-o":
+            self.pos += 1
+            result = self.expr_and() or result
+        return result
+
+    def expr_and(self):
+        result = self.expr_not()
+        while self.peek() == "-a":
+            self.pos += 1
+            result = self.expr_not() and result
+        return result
+
+    def expr_not(self):
+        if self.peek() == "!" and self.peek(1) is not None:
+            self.pos += 1
+            return not self.expr_not()
+        return self.primary()
+
+    def primary(self):
+        op = self.peek(1)
+        if op in self.binary or op in self.integer:
+            a = self.take()
+            self.pos += 1
+            b = self.take()
+            if op in self.binary:
+                return self.binary[op](a, b)
+            try:
+                return self.integer[op](int(a), int(b))
+            except ValueError:
+                raise TestError("integer expression expected")
+        t = self.take()
+        if t == "(" and self.pos < len(self.args):
+            result = self.expr_or()
+            if self.take() != ")":
+                raise TestError("')' expected")
+            return result
+        if t in self.unary and self.pos < len(self.args):
+            return self.unary[t](self.take())
+        return t != ""
+
+def builtin_test(args, stdin, stdout, stderr):
+    name = args[0]
+    args = args[1:]
+    if name == "[":
+        if not args or args[-1] != "]":
+            print >>stderr, "pysh: [: missing ]"
+            return 2
+        args = args[:-1]
+    try:
+        return 0 if Test(args).evaluate() else 1
+    except TestError as e:
+        print >>stderr, "pysh: {}: {}".format(name, e)
+        return 2
+
+def builtin_hash(args, stdin, stdout, stderr):
+    if args[1:] == ["-r"]:
+        COMMANDS.clear()
+        return 0
+    if len(args) == 1:
+        if not COMMANDS.table:
+            print >>stdout, "hash: hash table empty"
+            return 0
+        print >>stdout, "hits\tcommand"
+        for name, (path, hits) in COMMANDS.table.iteritems():
+            print >>stdout, "{:4d}\t{}".format(hits, path)
+        return 0
+    status = 0
+    for name in args[1:]:
+        if COMMANDS.find(name, count=False) is None:
+            print >>stderr, "pysh: hash: {}: not found".format(name)
+            status = 1
+    return status
+
+def builtin_jobs(args, stdin, stdout, stderr):
+    only_pids = args[1:2] == ["-p"]
+    specs = args[2:] if only_pids else args[1:]
+    jobs = JOBS.jobs.values()
+    if specs:
+        jobs = [JOBS.get(spec) for spec in specs]
+        if None in jobs:
+            print >>stderr, "pysh: jobs: {}: no such job".format(specs[jobs.index(None)])
+            return 1
+    for job in jobs:
+        if only_pids:
+            print >>stdout, job.pids[-1]
+        else:
+            print >>stdout, JOBS.format(job)
+    # 終わったことを見せたジョブは外す
+    for job in jobs:
+        if job.done():
+            JOBS.remove(job)
+    return 0
+
+def builtin_wait(args, stdin, stdout, stderr):
+    if len(args) == 1:
+        for job in JOBS.jobs.values():
+            job.wait()
+            if job.done():
+                JOBS.remove(job)
+        return 0
+    status = 0
+    for spec in args[1:]:
+        job = JOBS.get(spec)
+        if job is None:
+            if not spec.startswith("%") and spec.isdigit() and int(spec) in JOBS.reaped:
+                status = exit_code(JOBS.reaped.pop(int(spec)))
+                continue
+            print >>stderr, "pysh: wait: {}: no such job".format(spec)
+            status = 127
+            continue
+        job.wait()
+        if job.stopped:
+            status = 128 + signal.SIGTSTP
+        elif not spec.startswith("%"):
+            status = job.codes.get(int(spec), 0)
+        else:
+            status = job.exit_status()
+        if job.done():
+            JOBS.remove(job)
+    return status
+
+def builtin_fg(args, stdin, stdout, stderr):
+    job = JOBS.get(args[1] if len(args) > 1 else None)
+    if job is None:
+        print >>stderr, "pysh: fg: {}: no such job".format(args[1] if len(args) > 1 else "current")
+        return 1
+    print >>stdout, job.command
+    stdout.flush()
+    return job.foreground()
+
+def builtin_bg(args, stdin, stdout, stderr):
+    status = 0
+    for spec in args[1:] or [None]:
+        job = JOBS.get(spec)
+        if job is None:
+            print >>stderr, "pysh: bg: {}: no such job".format(spec or "current")
+            status = 1
+            continue
+        job.stopped = False
+        try:
+            os.killpg(job.pgid, signal.SIGCONT)
+        except OSError:
+            pass
+        print >>stdout, "[{}] {} &".format(job.id, job.command)
+    return status
+
+# 引数を1つのコマンドとして子プロセスで動かしてpidを返す(組み込みコマンドならforkした中で動かす)
+def start_command(args, stdin, stdout, stderr):
+    if args[0] not in BUILTINS:
+        return system(args, stdin, stdout, stderr)
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            reset_child()
+            status = run_builtin(args, [], stdin, stdout, stderr)
+            stdout.flush()
+            sys.stdout.flush()
+        finally:
+            os._exit(status)
+    return pid
+
+def builtin_parallel(args, stdin, stdout, stderr):
+    """
+    parallel [-j N] [-n M] [-I STR] command [arg...]
+    標準入力の1行を1つの引数として、commandにM個ずつ付けて(-Iなら引数の中のSTRを置き換えて)
+    同時にN個まで動かす、xargs -Pのようなもの
+    Nの省略値はCPUの数、1つでも失敗すれば123を返す
+    動かしたコマンドはジョブの表に入れないので、jobs/wait/fg/bgでは扱えない
+    (parallel自体を&で動かせば、それらはそのジョブのプロセスグループに入る)
+    """
+    try:
+        opts, command = getopt.getopt(args[1:], "j:n:I:")
+        opts = dict(opts)
+        limit = int(opts.get("-j", 0)) or os.sysconf("SC_NPROCESSORS_ONLN")
+        count = int(opts.get("-n", 1))
+    except (getopt.GetoptError, ValueError) as e:
+        print >>stderr, "pysh: parallel: {}".format(e)
+        return 2
+    if not command or count < 1:
+        print >>stderr, "pysh: parallel: usage: parallel [-j N] [-n M] [-I STR] command [arg...]"
+        return 2
+    replace = opts.get("-I")
+    running = set()
+    failed = [False]
+
+    # どれかが終わるまで待って外す、SIGCHLDのハンドラは止めてここで回収する
+    def collect():
+        JOBS.wait_one()
+        for pid in list(running):
+            if pid in JOBS.reaped:
+                running.remove(pid)
+                if exit_code(JOBS.reaped.pop(pid)) != 0:
+                    failed[0] = True
+
+    def launch(items):
+        if replace is None:
+            cmd = command + items
+        else:
+            cmd = [a.replace(replace, " ".join(items)) for a in command]
+        while len(running) >= limit:
+            collect()
+        pid = start_command(cmd, devnull, stdout, stderr)
+        if pid is None:
+            failed[0] = True
+        else:
+            running.add(pid)
+
+    # 子プロセスには標準入力を渡さない(引数の行を読んでしまわないように)
+    devnull = open(os.devnull)
+    with JOBS.holding():
+        try:
+            items = []
+            for line in stdin:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                items.append(line)
+                if len(items) == count:
+                    launch(items)
+                    items = []
+            if items:
+                launch(items)
+            while running:
+                collect()
+        except KeyboardInterrupt:
+            for pid in running:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            raise
+        finally:
+            devnull.close()
+    return 123 if failed[0] else 0
+
+BUILTINS = {
+    ":": builtin_true,
+    "true": builtin_true,
+    "false": builtin_false,
+    "echo": builtin_echo,
+    "cd": builtin_cd,
+    "export": builtin_export,
+    "test": builtin_test,
+    "[": builtin_test,
+    "hash": builtin_hash,
+    "jobs": builtin_jobs,
+    "wait": builtin_wait,
+    "fg": builtin_fg,
+    "bg": builtin_bg,
+    "parallel": builtin_parallel,
+}
+
+# 待たずに動かしてジョブの表に入れる、パイプライン以外は子プロセスの中でASTを実行する
+# どちらも自分のプロセスグループで動かし、端末から読もうとしたら止まるようにする
+def start_background(exp, stdin, stdout, stderr):
+    if exp["type"] == "pipeline" and not exp["neg"]:
+        job = Pipeline(exp)
+        job.start(stdin, stdout, stderr)
+    else:
+        job = Job(exp)
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                reset_child()
+                os.setpgid(0, 0)
+                status = eval_exp(exp, stdin, stdout, stderr, exec_last=True)
+                sys.stdout.flush()
+            finally:
+                os._exit(status)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        job.add_pid(pid)
+    JOBS.add(job)
+    ENV["!"] = str(job.pids[-1])
+    if JOBS.interactive:
+        print >>sys.stderr, "[{}] {}".format(job.id, job.pids[-1])
+
+# ASTを文字列に戻す(jobsで見せる)
+def format_exp(exp):
+    if exp["type"] == "list":
+        return " ".join(format_exp(e) + (" &" if background else ";")
+                        for e, background in exp["items"]).rstrip(";")
+    if exp["type"] == "exp" and "sep" in exp:
+        return "{} {} {}".format(format_exp(exp["left"]), exp["sep"], format_exp(exp["right"]))
+    if exp["type"] == "pipeline":
+        s = format_exp(exp["stages"][0])
+        for e, pipe_stderr in zip(exp["stages"][1:], exp["stderr"]):
+            s += (" |& " if pipe_stderr else " | ") + format_exp(e)
+    elif exp["type"] == "group":
+        s = "( {} )".format(format_exp(exp["body"]))
+    else:
+        s = " ".join(["{}={}".format(name, format_word(value)) for name, value in exp["assign"]] +
+                     [format_word(a) for a in exp["arg"]])
+    for red in exp.get("extention", []):
+        s += " {} {}".format(red["op"], format_word(red["arg"]))
+    return "! " + s if exp["neg"] else s
+
+def format_word(word):
+    if word["type"] == "string":
+        return pipes.quote(word["value"])
+    if word["type"] == "variable":
+        return "$" + word["name"]
+    return "".join(format_word(p) for p in word["parts"])
 
 def repl():
     import readline
@@ -267,20 +1251,30 @@ def repl():
     except IOError:
         pass
     atexit.register(readline.write_history_file, hist)
+    JOBS.interactive = True
+    # 端末からのシグナルで止まるのは前面のジョブだけにする
+    for sig in CHILD_DEFAULT_SIGNALS[1:]:
+        signal.signal(sig, signal.SIG_IGN)
     while True:
+        JOBS.notify(sys.stderr)
         parser.feed(raw_input("$ "))
         while not parser.parse():
             parser.feed("\n")
             parser.feed(raw_input("> "))
         tokens = parser.pop_tokens()
-        eval_tokens(tokens)
+        if tokens:
+            try:
+                eval_exp(build_exp(tokens))
+            except ParseError as e:
+                print >>sys.stderr, "pysh: syntax error: {}".format(e)
 
 def eval_string(s):
-    parser = Parser()
-    parser.feed(s)
-    parser.parse()
-    tokens = parser.pop_tokens()
-    return eval_tokens(tokens)
+    try:
+        exp = compile_string(s)
+    except ParseError as e:
+        print >>sys.stderr, "pysh: syntax error: {}".format(e)
+        return 2
+    return eval_exp(exp)
 
 if __name__ == '__main__':
     print "This is pysh"
@@ -290,6 +1284,9 @@ if __name__ == '__main__':
     p.add_argument("file", nargs="?")
     p.add_argument("arg", nargs="*")
     args = p.parse_args(sys.argv[1:])
+    install_sigchld()
+    ENV["$"] = str(os.getpid())  # forkした子でもシェル自身のpidのまま
+    ENV["#"] = str(len(args.arg) if args.file is not None else 0)
     if (args.c is not None):
         eval_string(args.c)
     elif (args.file is not None):